@@ -31,6 +31,37 @@ from device_cloud._core.constants import DEFAULT_CONFIG_FILE
 from device_cloud._core.constants import DEFAULT_KEEP_ALIVE
 from device_cloud._core.constants import DEFAULT_LOOP_TIME
 from device_cloud._core.constants import DEFAULT_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_ACTION_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_TRANSFER_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_MESSAGE_QUEUE_SIZE
+from device_cloud._core.constants import DEFAULT_ACTION_QUEUE_SIZE
+from device_cloud._core.constants import DEFAULT_TRANSFER_QUEUE_SIZE
+from device_cloud._core.constants import DEFAULT_WORKER_MIN_THREADS
+from device_cloud._core.constants import DEFAULT_WORKER_WAIT_TARGET
+from device_cloud._core.constants import DEFAULT_WORKER_IDLE_TIMEOUT
+from device_cloud._core.constants import DEFAULT_PUBLISH_MAX_COMMANDS
+from device_cloud._core.constants import DEFAULT_PUBLISH_MAX_BYTES
+from device_cloud._core.constants import DEFAULT_PUBLISH_MAX_BATCH
+from device_cloud._core.constants import DEFAULT_LOG_PAYLOAD_SAMPLE
+from device_cloud._core.constants import DEFAULT_LOG_PAYLOAD_SUMMARY
+from device_cloud._core.constants import DEFAULT_PUBLISH_NO_REPLY
+from device_cloud._core.constants import DEFAULT_PUBLISH_LINGER
+from device_cloud._core.constants import DEFAULT_PUBLISH_LINGER_COUNT
+from device_cloud._core.constants import DEFAULT_MAX_IN_FLIGHT
+from device_cloud._core.constants import DEFAULT_IN_FLIGHT_TIMEOUT
+from device_cloud._core.constants import DEFAULT_REPLY_TIMEOUT
+from device_cloud._core.constants import DEFAULT_REPLY_RETRIES
+from device_cloud._core.constants import DEFAULT_MAILBOX_PAGE_SIZE
+from device_cloud._core.constants import DEFAULT_MAILBOX_WATERMARK
+from device_cloud._core.constants import DEFAULT_MAILBOX_CACHE_SIZE
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_SIZE
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_POLICY
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_TIMEOUT
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_SAMPLE
+from device_cloud._core.constants import DEFAULT_PUBLISH_PRIORITY_WEIGHTS
+from device_cloud._core.constants import DEFAULT_SPOOL_MAX_SIZE
+from device_cloud._core.constants import DEFAULT_SPOOL_MAX_AGE
+from device_cloud._core.constants import DEFAULT_SPOOL_DRAIN_RATE
 
 from device_cloud._core.constants import STATUS_SUCCESS
 from device_cloud._core.constants import STATUS_INVOKED
@@ -67,6 +98,37 @@ __all__ = ["Client",
            "DEFAULT_KEEP_ALIVE",
            "DEFAULT_LOOP_TIME",
            "DEFAULT_THREAD_COUNT",
+           "DEFAULT_ACTION_THREAD_COUNT",
+           "DEFAULT_TRANSFER_THREAD_COUNT",
+           "DEFAULT_MESSAGE_QUEUE_SIZE",
+           "DEFAULT_ACTION_QUEUE_SIZE",
+           "DEFAULT_TRANSFER_QUEUE_SIZE",
+           "DEFAULT_WORKER_MIN_THREADS",
+           "DEFAULT_WORKER_WAIT_TARGET",
+           "DEFAULT_WORKER_IDLE_TIMEOUT",
+           "DEFAULT_PUBLISH_MAX_COMMANDS",
+           "DEFAULT_PUBLISH_MAX_BYTES",
+           "DEFAULT_PUBLISH_MAX_BATCH",
+           "DEFAULT_LOG_PAYLOAD_SAMPLE",
+           "DEFAULT_LOG_PAYLOAD_SUMMARY",
+           "DEFAULT_PUBLISH_NO_REPLY",
+           "DEFAULT_PUBLISH_LINGER",
+           "DEFAULT_PUBLISH_LINGER_COUNT",
+           "DEFAULT_MAX_IN_FLIGHT",
+           "DEFAULT_IN_FLIGHT_TIMEOUT",
+           "DEFAULT_REPLY_TIMEOUT",
+           "DEFAULT_REPLY_RETRIES",
+           "DEFAULT_MAILBOX_PAGE_SIZE",
+           "DEFAULT_MAILBOX_WATERMARK",
+           "DEFAULT_MAILBOX_CACHE_SIZE",
+           "DEFAULT_PUBLISH_QUEUE_SIZE",
+           "DEFAULT_PUBLISH_QUEUE_POLICY",
+           "DEFAULT_PUBLISH_QUEUE_TIMEOUT",
+           "DEFAULT_PUBLISH_QUEUE_SAMPLE",
+           "DEFAULT_PUBLISH_PRIORITY_WEIGHTS",
+           "DEFAULT_SPOOL_MAX_SIZE",
+           "DEFAULT_SPOOL_MAX_AGE",
+           "DEFAULT_SPOOL_DRAIN_RATE",
            "LOGCRITICAL",
            "LOGERROR",
            "LOGDEBUG",
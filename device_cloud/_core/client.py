@@ -25,8 +25,39 @@ from device_cloud._core.constants import DEFAULT_CONFIG_FILE
 from device_cloud._core.constants import DEFAULT_KEEP_ALIVE
 from device_cloud._core.constants import DEFAULT_LOOP_TIME
 from device_cloud._core.constants import DEFAULT_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_ACTION_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_TRANSFER_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_MESSAGE_QUEUE_SIZE
+from device_cloud._core.constants import DEFAULT_ACTION_QUEUE_SIZE
+from device_cloud._core.constants import DEFAULT_TRANSFER_QUEUE_SIZE
+from device_cloud._core.constants import DEFAULT_WORKER_MIN_THREADS
+from device_cloud._core.constants import DEFAULT_WORKER_WAIT_TARGET
+from device_cloud._core.constants import DEFAULT_WORKER_IDLE_TIMEOUT
+from device_cloud._core.constants import DEFAULT_PUBLISH_MAX_COMMANDS
+from device_cloud._core.constants import DEFAULT_PUBLISH_MAX_BYTES
+from device_cloud._core.constants import DEFAULT_PUBLISH_MAX_BATCH
+from device_cloud._core.constants import DEFAULT_LOG_PAYLOAD_SAMPLE
+from device_cloud._core.constants import DEFAULT_LOG_PAYLOAD_SUMMARY
+from device_cloud._core.constants import DEFAULT_PUBLISH_NO_REPLY
+from device_cloud._core.constants import DEFAULT_PUBLISH_LINGER
+from device_cloud._core.constants import DEFAULT_PUBLISH_LINGER_COUNT
+from device_cloud._core.constants import DEFAULT_MAX_IN_FLIGHT
+from device_cloud._core.constants import DEFAULT_IN_FLIGHT_TIMEOUT
+from device_cloud._core.constants import DEFAULT_REPLY_TIMEOUT
+from device_cloud._core.constants import DEFAULT_REPLY_RETRIES
+from device_cloud._core.constants import DEFAULT_MAILBOX_PAGE_SIZE
+from device_cloud._core.constants import DEFAULT_MAILBOX_WATERMARK
+from device_cloud._core.constants import DEFAULT_MAILBOX_CACHE_SIZE
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_SIZE
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_POLICY
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_TIMEOUT
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_SAMPLE
+from device_cloud._core.constants import DEFAULT_PUBLISH_PRIORITY_WEIGHTS
+from device_cloud._core.constants import DEFAULT_SPOOL_MAX_SIZE
+from device_cloud._core.constants import DEFAULT_SPOOL_MAX_AGE
+from device_cloud._core.constants import DEFAULT_SPOOL_DRAIN_RATE
+from device_cloud._core.constants import STATUS_BAD_PARAMETER
 from device_cloud._core.constants import STATUS_SUCCESS
-from device_cloud._core.constants import WORK_PUBLISH
 from device_cloud._core import defs
 from device_cloud._core.handler import Handler
 
@@ -179,6 +210,37 @@ class Client(object):
             "keep_alive":DEFAULT_KEEP_ALIVE,
             "loop_time":DEFAULT_LOOP_TIME,
             "thread_count":DEFAULT_THREAD_COUNT,
+            "action_thread_count":DEFAULT_ACTION_THREAD_COUNT,
+            "transfer_thread_count":DEFAULT_TRANSFER_THREAD_COUNT,
+            "message_queue_size":DEFAULT_MESSAGE_QUEUE_SIZE,
+            "action_queue_size":DEFAULT_ACTION_QUEUE_SIZE,
+            "transfer_queue_size":DEFAULT_TRANSFER_QUEUE_SIZE,
+            "worker_min_threads":DEFAULT_WORKER_MIN_THREADS,
+            "worker_wait_target":DEFAULT_WORKER_WAIT_TARGET,
+            "worker_idle_timeout":DEFAULT_WORKER_IDLE_TIMEOUT,
+            "publish_max_commands":DEFAULT_PUBLISH_MAX_COMMANDS,
+            "publish_max_bytes":DEFAULT_PUBLISH_MAX_BYTES,
+            "publish_max_batch":DEFAULT_PUBLISH_MAX_BATCH,
+            "publish_no_reply":DEFAULT_PUBLISH_NO_REPLY,
+            "publish_linger":DEFAULT_PUBLISH_LINGER,
+            "publish_linger_count":DEFAULT_PUBLISH_LINGER_COUNT,
+            "max_in_flight":DEFAULT_MAX_IN_FLIGHT,
+            "in_flight_timeout":DEFAULT_IN_FLIGHT_TIMEOUT,
+            "reply_timeout":DEFAULT_REPLY_TIMEOUT,
+            "reply_retries":DEFAULT_REPLY_RETRIES,
+            "mailbox_page_size":DEFAULT_MAILBOX_PAGE_SIZE,
+            "mailbox_watermark":DEFAULT_MAILBOX_WATERMARK,
+            "mailbox_cache_size":DEFAULT_MAILBOX_CACHE_SIZE,
+            "publish_queue_size":DEFAULT_PUBLISH_QUEUE_SIZE,
+            "publish_queue_policy":DEFAULT_PUBLISH_QUEUE_POLICY,
+            "publish_queue_timeout":DEFAULT_PUBLISH_QUEUE_TIMEOUT,
+            "publish_queue_sample":DEFAULT_PUBLISH_QUEUE_SAMPLE,
+            "publish_priority_weights":DEFAULT_PUBLISH_PRIORITY_WEIGHTS,
+            "spool_max_size":DEFAULT_SPOOL_MAX_SIZE,
+            "spool_max_age":DEFAULT_SPOOL_MAX_AGE,
+            "spool_drain_rate":DEFAULT_SPOOL_DRAIN_RATE,
+            "log_payload_sample":DEFAULT_LOG_PAYLOAD_SAMPLE,
+            "log_payload_summary":DEFAULT_LOG_PAYLOAD_SUMMARY,
             "ca_bundle_file":certifi.where()
         }
         self.config.update(config_defaults, False)
@@ -301,13 +363,32 @@ class Client(object):
           message             (string) Optional message to accompany alarm
 
         Returns:
+          STATUS_FULL                  Publish queue is full
           STATUS_SUCCESS               Alarm has been queued for publishing
         """
 
         alarm = defs.PublishAlarm(alarm_name, state, message)
-        self.handler.queue_publish(alarm)
-        work = defs.Work(WORK_PUBLISH, None)
-        return self.handler.queue_work(work)
+        return self.handler.queue_publish(alarm)
+
+    def alarm_publish_async(self, alarm_name, state, message=None):
+        """
+        Publish an alarm to the Cloud without waiting for the result
+
+        Parameters:
+          alarm_name          (string) Name of alarm to publish
+          state                  (int) State of publish
+          message             (string) Optional message to accompany alarm
+
+        Returns:
+          Future                       Resolved with STATUS_SUCCESS once the
+                                       Cloud accepts the alarm, or
+                                       STATUS_FAILURE, STATUS_FULL,
+                                       STATUS_TIMED_OUT or STATUS_TRY_AGAIN
+                                       (spooled while disconnected)
+        """
+
+        alarm = defs.PublishAlarm(alarm_name, state, message)
+        return self.handler.queue_future(alarm)
 
     def attribute_publish(self, attribute_name, value):
         """
@@ -318,12 +399,32 @@ class Client(object):
           value               (string) Value to publish
 
         Returns:
+          STATUS_FULL                  Publish queue is full
           STATUS_SUCCESS               Attribute has been queued for publishing
         """
 
         attr = defs.PublishAttribute(attribute_name, value)
         return self.handler.queue_publish(attr)
 
+    def attribute_publish_async(self, attribute_name, value):
+        """
+        Publish string telemetry to the Cloud without waiting for the result
+
+        Parameters:
+          attribute_name      (string) Name of attribute to publish to
+          value               (string) Value to publish
+
+        Returns:
+          Future                       Resolved with STATUS_SUCCESS once the
+                                       Cloud accepts the attribute, or
+                                       STATUS_FAILURE, STATUS_FULL,
+                                       STATUS_TIMED_OUT or STATUS_TRY_AGAIN
+                                       (spooled while disconnected)
+        """
+
+        attr = defs.PublishAttribute(attribute_name, value)
+        return self.handler.queue_future(attr)
+
     def connect(self, timeout=0):
         """
         Connect the Client to the Cloud
@@ -391,12 +492,31 @@ class Client(object):
           message             (string) Message to publish
 
         Returns:
+          STATUS_FULL                  Publish queue is full
           STATUS_SUCCESS               Event has been queued for publishing
         """
 
         log = defs.PublishLog(message)
         return self.handler.queue_publish(log)
 
+    def event_publish_async(self, message):
+        """
+        Publishes an event message to the Cloud without waiting for the result
+
+        Parameters:
+          message             (string) Message to publish
+
+        Returns:
+          Future                       Resolved with STATUS_SUCCESS once the
+                                       Cloud accepts the event, or
+                                       STATUS_FAILURE, STATUS_FULL,
+                                       STATUS_TIMED_OUT or STATUS_TRY_AGAIN
+                                       (spooled while disconnected)
+        """
+
+        log = defs.PublishLog(message)
+        return self.handler.queue_future(log)
+
     def file_download(self, file_name, download_dest, blocking=False,
                       callback=None, timeout=0, file_global=False):
         """
@@ -429,6 +549,30 @@ class Client(object):
         return self.handler.request_download(file_name, download_dest, blocking,
                                              callback, timeout, file_global)
 
+    def file_download_async(self, file_name, download_dest, callback=None,
+                            file_global=False):
+        """
+        Download a file from the Cloud to the device (C2D) without waiting for
+        the transfer. file_download with blocking set waits on this future.
+
+        Parameters:
+          file_name           (string) File in Cloud to download
+          download_dest       (string) Destination for downloaded file
+          callback              (func) Function to be executed as soon as file
+                                       transfer is complete. It will be passed
+                                       (client, file_name, status).
+          file_global                  Flag that indicates whether or not the
+                                       file to download is in the global file
+                                       store or the thing's file store
+
+        Returns:
+          Future                       Resolved with the status file_download
+                                       returns when blocking
+        """
+
+        return self.handler.request_download_async(file_name, download_dest,
+                                                   callback, file_global)
+
     def file_upload(self, file_path, upload_name=None, blocking=False,
                     callback=None, timeout=0, file_global=False):
         """
@@ -462,6 +606,31 @@ class Client(object):
         return self.handler.request_upload(file_path, upload_name, blocking,
                                            callback, timeout, file_global)
 
+    def file_upload_async(self, file_path, upload_name=None, callback=None,
+                          file_global=False):
+        """
+        Upload a file from the device to the Cloud (D2C) without waiting for
+        the transfer. file_upload with blocking set waits on this future.
+
+        Parameters:
+          file_path           (string) Absolute path for file to upload.
+          upload_name         (string) Name for file uploaded in Cloud.
+                                       Default is the file name on the device.
+          callback              (func) Function to be executed as soon as file
+                                       transfer is complete. It will be passed
+                                       (client, file_name, status).
+          file_global                  Flag that indicates whether or not the
+                                       file should be uploaded to the global
+                                       file store or the thing's file store
+
+        Returns:
+          Future                       Resolved with the status file_upload
+                                       returns when blocking
+        """
+
+        return self.handler.request_upload_async(file_path, upload_name,
+                                                 callback, file_global)
+
     def is_alive(self):
         """
         Return whether or not the Client has exited
@@ -499,6 +668,7 @@ class Client(object):
           fix_type            (string) Fix type
 
         Returns:
+          STATUS_FULL                  Publish queue is full
           STATUS_SUCCESS               Location has been queued for publishing
         """
 
@@ -507,18 +677,161 @@ class Client(object):
                                         accuracy=accuracy, fix_type=fix_type)
         return self.handler.queue_publish(location)
 
+    def location_publish_async(self, latitude, longitude, heading=None,
+                               altitude=None, speed=None, accuracy=None,
+                               fix_type=None):
+        """
+        Publish a location metric to the Cloud without waiting for the result
+
+        Parameters:
+          latitude            (number) Latitude coordinate
+          longitude           (number) Longitude coordinate
+          heading             (number) Heading
+          altitude            (number) Altitude
+          speed               (number) Speed
+          accuracy            (number) Accuracy of fix
+          fix_type            (string) Fix type
+
+        Returns:
+          Future                       Resolved with STATUS_SUCCESS once the
+                                       Cloud accepts the location, or
+                                       STATUS_FAILURE, STATUS_FULL,
+                                       STATUS_TIMED_OUT or STATUS_TRY_AGAIN
+                                       (spooled while disconnected)
+        """
+
+        location = defs.PublishLocation(latitude, longitude, heading=heading,
+                                        altitude=altitude, speed=speed,
+                                        accuracy=accuracy, fix_type=fix_type)
+        return self.handler.queue_future(location)
+
+    def publish_queue_stats(self):
+        """
+        Return statistics of the publish queue
+
+        Returns:
+          dict                         size (pending publishes), maxsize,
+                                       blocked (publishes that waited for room)
+                                       and dropped (publishes rejected or
+                                       discarded because the queue was full)
+        """
+
+        return self.handler.publish_queue.stats()
+
+    def reply_stats(self):
+        """
+        Return statistics of commands waiting for replies from the Cloud
+
+        Returns:
+          dict                         in_flight (commands waiting for a
+                                       reply), retried (commands sent again
+                                       after their reply timed out) and
+                                       expired (commands given up on)
+        """
+
+        return {"in_flight":len(self.handler.reply_tracker),
+                "retried":self.handler.replies_retried,
+                "expired":self.handler.replies_expired}
+
+    def work_stats(self):
+        """
+        Return statistics of the pools of worker threads
+
+        Returns:
+          dict                         for each pool ("message", "action" and
+                                       "transfer"), a dict of size (current
+                                       number of threads), min_size, max_size,
+                                       queued (work waiting for a thread) and
+                                       wait_p50, wait_p90 and wait_p99
+                                       (percentiles of recent queue wait times
+                                       in seconds)
+        """
+
+        return dict((name, pool.stats()) for name, pool in
+                    self.handler.work_pools.items())
+
     def telemetry_publish(self, telemetry_name, value):
         """
-        Publish telemetry to the Cloud
+        Publish telemetry to the Cloud. If compression is configured for the
+        property in telemetry_compression, the value may be held back or
+        dropped.
 
         Parameters:
           telemetry_name      (string) Name of property to publish to
           value               (number) Value to publish
 
         Returns:
+          STATUS_FULL                  Publish queue is full
           STATUS_SUCCESS               Telemetry has been queued for publishing
         """
 
         telem = defs.PublishTelemetry(telemetry_name, value)
-        return self.handler.queue_publish(telem)
+        return self.handler.queue_telemetry(telem)
+
+    def telemetry_publish_async(self, telemetry_name, value):
+        """
+        Publish telemetry to the Cloud without waiting for the result. If the
+        property is compressed or aggregated, the future is resolved once the
+        value has been taken in.
+
+        Parameters:
+          telemetry_name      (string) Name of property to publish to
+          value               (number) Value to publish
+
+        Returns:
+          Future                       Resolved with STATUS_SUCCESS once the
+                                       Cloud accepts the telemetry, or
+                                       STATUS_FAILURE, STATUS_FULL,
+                                       STATUS_TIMED_OUT or STATUS_TRY_AGAIN
+                                       (spooled while disconnected)
+        """
+
+        telem = defs.PublishTelemetry(telemetry_name, value)
+        return self.handler.queue_future(telem)
+
+    def telemetry_publish_many(self, telemetry_name, values, timestamps=None,
+                               interval=None, start=None):
+        """
+        Publish a block of telemetry samples for one property to the Cloud.
+        Each value needs its own time, either from timestamps or spaced
+        interval seconds apart, as values sharing a timestamp overwrite each
+        other on the Cloud.
+
+        Parameters:
+          telemetry_name      (string) Name of property to publish to
+          values            (sequence) Numbers to publish. Any sequence or
+                                       buffer such as array.array or a NumPy
+                                       array.
+          timestamps        (sequence) Optional time of each value in seconds
+                                       since the epoch (UTC)
+          interval             (float) Optional seconds between values, when
+                                       timestamps are omitted
+          start                (float) Optional time of the first value when
+                                       interval is given. By default the last
+                                       value is at the current time.
+
+        Returns:
+          STATUS_BAD_PARAMETER         timestamps and values differ in length,
+                                       or several values have neither
+                                       timestamps nor an interval
+          STATUS_FULL                  Publish queue is full
+          STATUS_SUCCESS               Telemetry has been queued for publishing
+        """
 
+        block = defs.PublishTelemetryBlock(telemetry_name, values, timestamps,
+                                           interval, start)
+        if (block.timestamps is not None and
+                len(block.timestamps) != len(block.values)):
+            self.handler.logger.error("Telemetry block for %s has %d values "
+                                      "but %d timestamps", telemetry_name,
+                                      len(block.values), len(block.timestamps))
+            return STATUS_BAD_PARAMETER
+        if (block.timestamps is None and block.interval is None and
+                len(block.values) > 1):
+            self.handler.logger.error("Telemetry block for %s needs timestamps "
+                                      "or an interval for its %d values",
+                                      telemetry_name, len(block.values))
+            return STATUS_BAD_PARAMETER
+        if not block.values:
+            return STATUS_SUCCESS
+        return self.handler.queue_telemetry(block)
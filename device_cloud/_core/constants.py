@@ -27,8 +27,100 @@ DEFAULT_CONFIG_FILE = "{}-connect.cfg"
 DEFAULT_KEEP_ALIVE = 0
 # Default loop time for MQTT in seconds
 DEFAULT_LOOP_TIME = 1
-# Default number of worker threads
+# Default maximum number of worker threads handling received messages
 DEFAULT_THREAD_COUNT = 3
+# Default maximum number of worker threads executing actions
+DEFAULT_ACTION_THREAD_COUNT = 2
+# Default maximum number of worker threads transferring files
+DEFAULT_TRANSFER_THREAD_COUNT = 2
+# Default minimum number of threads kept by each pool of worker threads
+DEFAULT_WORKER_MIN_THREADS = 1
+# Default time queued work may wait before a worker thread is added to its
+# pool, in seconds
+DEFAULT_WORKER_WAIT_TARGET = 0.05
+# Default time after which an idle worker thread above the minimum is retired,
+# in seconds. 0 means never
+DEFAULT_WORKER_IDLE_TIMEOUT = 60
+# Default maximum number of received messages waiting to be handled
+# 0 means no limit
+DEFAULT_MESSAGE_QUEUE_SIZE = 10000
+# Default maximum number of actions waiting to be executed
+# 0 means no limit
+DEFAULT_ACTION_QUEUE_SIZE = 100
+# Default maximum number of file transfers waiting to start
+# 0 means no limit
+DEFAULT_TRANSFER_QUEUE_SIZE = 100
+# Default maximum number of commands sent in a single publish payload
+DEFAULT_PUBLISH_MAX_COMMANDS = 500
+# Default maximum size of a single publish payload in bytes
+DEFAULT_PUBLISH_MAX_BYTES = 131072
+# Default maximum number of values in a single property.batch command
+DEFAULT_PUBLISH_MAX_BATCH = 1000
+# Default fraction of sent payloads that are logged
+# 1 means every payload, 0 means none
+DEFAULT_LOG_PAYLOAD_SAMPLE = 1
+# Default for logging a summary of each publish flush instead of payloads
+DEFAULT_LOG_PAYLOAD_SUMMARY = False
+# Default publish types sent without tracking replies
+DEFAULT_PUBLISH_NO_REPLY = []
+# Default time to wait for more publishes after the first one is queued, in
+# seconds
+DEFAULT_PUBLISH_LINGER = 0.005
+# Default number of pending publishes that are sent without waiting for the
+# rest of the linger time
+DEFAULT_PUBLISH_LINGER_COUNT = 500
+# Default maximum number of payloads waiting for replies
+DEFAULT_MAX_IN_FLIGHT = 1024
+# Default time to wait for a reply to free a payload slot in seconds, once the
+# maximum number of payloads are waiting for replies
+DEFAULT_IN_FLIGHT_TIMEOUT = 10.0
+# Default time to wait for the reply to a command in seconds
+# 0 means wait forever
+DEFAULT_REPLY_TIMEOUT = 60
+# Default number of times a command that can safely be repeated is sent again
+# when its reply times out. The timeout doubles with each retry.
+DEFAULT_REPLY_RETRIES = 3
+# Default maximum number of messages requested by each mailbox check
+# 0 means no limit
+DEFAULT_MAILBOX_PAGE_SIZE = 50
+# Default number of mailbox actions in progress at which the next page of the
+# mailbox is not requested until some of them complete. Kept below
+# DEFAULT_MAILBOX_PAGE_SIZE. 0 means no limit when there is no page size
+DEFAULT_MAILBOX_WATERMARK = 10
+# Default number of acks of executed mailbox actions remembered, so actions
+# delivered again are answered without executing them twice. 0 disables this
+DEFAULT_MAILBOX_CACHE_SIZE = 0
+# Default maximum number of publishes waiting in the publish queue
+# 0 means no limit
+DEFAULT_PUBLISH_QUEUE_SIZE = 10000
+# Default action when the publish queue is full
+DEFAULT_PUBLISH_QUEUE_POLICY = "drop_oldest"
+# Default time to wait for room in a full publish queue in seconds
+DEFAULT_PUBLISH_QUEUE_TIMEOUT = 1.0
+# Default fraction of publishes kept when sampling a full publish queue
+# 10 means one in every 10
+DEFAULT_PUBLISH_QUEUE_SAMPLE = 10
+# Default number of publishes taken from each priority lane, most urgent first,
+# in each round of draining the publish queue
+DEFAULT_PUBLISH_PRIORITY_WEIGHTS = [8, 4, 2, 1]
+# Default maximum size of the publish spool in bytes
+# 0 means no limit
+DEFAULT_SPOOL_MAX_SIZE = 10485760
+# Default maximum age of spooled publishes in seconds
+# 0 means no limit
+DEFAULT_SPOOL_MAX_AGE = 604800
+# Time between checks for replies that have timed out in seconds
+REPLY_SWEEP_INTERVAL = 1
+# Number of recent queue wait times kept by each worker pool for percentiles
+WORKER_WAIT_SAMPLES = 1000
+# Default number of spooled publishes sent per second after reconnecting
+DEFAULT_SPOOL_DRAIN_RATE = 500
+# Spool file name
+# {} is replaced with app id
+SPOOL_FILE = "{}-spool.db"
+# Mailbox action cache file name
+# {} is replaced with app id
+MAILBOX_CACHE_FILE = "{}-mailbox.json"
 
 
 # PORTS THAT REQUIRE SSL CONNECTIONS
@@ -131,11 +223,55 @@ TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
 
 # Parse a received message
 WORK_MESSAGE = 0
-# Publish pending publishes
-WORK_PUBLISH = 1
 # Execute a requested action
 WORK_ACTION = 2
 # Download a file
 WORK_DOWNLOAD = 3
 # Upload a file
 WORK_UPLOAD = 4
+
+# Worker pool that handles each type of work
+WORK_POOLS = {
+    WORK_MESSAGE: "message",
+    WORK_ACTION: "action",
+    WORK_DOWNLOAD: "transfer",
+    WORK_UPLOAD: "transfer"
+}
+
+
+# PUBLISH QUEUE POLICIES
+
+# Wait for room, then reject the new publish
+POLICY_BLOCK = "block"
+# Discard the oldest pending publish
+POLICY_DROP_OLDEST = "drop_oldest"
+# Reject the new publish
+POLICY_DROP_NEWEST = "drop_newest"
+# Keep a sample of new publishes in place of the oldest pending publishes
+POLICY_SAMPLE = "sample"
+# All policies
+POLICIES = [POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_DROP_NEWEST,
+            POLICY_SAMPLE]
+
+
+# PUBLISH PRIORITIES (lower is more urgent)
+
+# Alarms
+PRIORITY_ALARM = 0
+# Attributes
+PRIORITY_ATTRIBUTE = 1
+# Locations
+PRIORITY_LOCATION = 1
+# Telemetry
+PRIORITY_TELEMETRY = 2
+# Logs and events
+PRIORITY_LOG = 3
+# Publishes at or above this priority are flushed without waiting
+PRIORITY_IMMEDIATE = PRIORITY_ALARM
+
+
+# TOPICS
+
+# Topic number for commands whose replies are not tracked. Never generated by
+# the topic counter. The Cloud still replies to them on this topic.
+NO_REPLY_TOPIC = "0000"
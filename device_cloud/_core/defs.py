@@ -15,13 +15,76 @@
 This module defines several helper classes for use in the device_cloud handler
 """
 
+import errno
 import inspect
 import json
+import os
 import subprocess
-from datetime import datetime
+import sys
+import threading
+from collections import OrderedDict
+from collections import deque
+from concurrent import futures
+from time import time
 
 from device_cloud._core import constants
 
+if sys.version_info.major == 2:
+    import Queue as queue
+else:
+    import queue
+
+
+def chain_futures(sources, target):
+    """
+    Resolve a future once all of the source futures are resolved, with the
+    first status that is not STATUS_SUCCESS, or STATUS_SUCCESS
+    """
+
+    if len(sources) == 1:
+        sources[0].add_done_callback(
+            lambda source: set_result(target, source.result()))
+        return
+
+    lock = threading.Lock()
+    remaining = [len(sources)]
+
+    def source_done(_source):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        status = constants.STATUS_SUCCESS
+        for source in sources:
+            if source.result() != constants.STATUS_SUCCESS:
+                status = source.result()
+                break
+        set_result(target, status)
+
+    for source in sources:
+        source.add_done_callback(source_done)
+
+# Serialises claiming futures in set_result
+_claim_lock = threading.Lock()
+
+def set_result(future, result):
+    """
+    Resolve a future, unless it is None, cancelled or already resolved
+    """
+
+    if future is None:
+        return
+    with _claim_lock:
+        # Futures are only set running here, so a running one has already
+        # been claimed by another result. Claiming a resolved future would
+        # log a critical error and raise.
+        if future.done() or future.running():
+            return
+        if not future.set_running_or_notify_cancel():
+            return
+    future.set_result(result)
+
+
 class Action(object):
     """
     Holds information associating an action and a callback
@@ -231,7 +294,22 @@ class FileTransfer(object):
         self.callback = callback
         self.file_id = file_id
         self.file_checksum = file_checksum
-        self.status = None
+        self.future = futures.Future()
+        self._status = None
+
+    @property
+    def status(self):
+        """
+        Status of the transfer, None while it is in progress. Setting it
+        resolves the future of the transfer.
+        """
+        return self._status
+
+    @status.setter
+    def status(self, value):
+        self._status = value
+        if value is not None:
+            set_result(self.future, value)
 
     def finish(self):
         """
@@ -241,14 +319,123 @@ class FileTransfer(object):
             self.callback(self.client, self.file_name, self.status)
 
 
+class LazyJson(object):
+    """
+    Formats a JSON object for logging only when the log record is emitted
+    """
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, indent=2, sort_keys=True)
+
+
+class MailCache(object):
+    """
+    Bounded cache of the acks sent for recently executed mailbox actions, by
+    mail id, evicting the least recently used first. It is kept in a JSON file
+    so it survives a restart. The file is replaced as a whole on each change,
+    so a crash leaves either the old or the new cache. A missing file starts
+    an empty cache, an unreadable one is discarded with a warning.
+    """
+
+    def __init__(self, path=None, max_size=constants.DEFAULT_MAILBOX_CACHE_SIZE,
+                 logger=None):
+        self.path = path
+        self.max_size = max_size
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.loaded = False
+
+    def __len__(self):
+        with self.lock:
+            self._load()
+            return len(self.entries)
+
+    def get(self, mail_id):
+        """
+        Returns the (command, description) of the ack sent for a mail id, or
+        None
+        """
+
+        with self.lock:
+            self._load()
+            entry = self.entries.pop(mail_id, None)
+            if entry is not None:
+                self.entries[mail_id] = entry
+            return entry
+
+    def put(self, mail_id, command, description):
+        """
+        Remember the ack sent for a mail id and save the cache. Raises IOError
+        or OSError if it cannot be saved, TypeError if an entry cannot be
+        serialised.
+        """
+
+        with self.lock:
+            self._load()
+            self.entries.pop(mail_id, None)
+            self.entries[mail_id] = (command, description)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            if self.path:
+                records = [[key, entry[0], entry[1]]
+                           for key, entry in self.entries.items()]
+                data = json.dumps(records, separators=(",", ":"))
+                temp_path = self.path + ".tmp"
+                with open(temp_path, "w") as cache_file:
+                    cache_file.write(data)
+                # os.replace overwrites on all platforms, Python 2 only has
+                # os.rename
+                getattr(os, "replace", os.rename)(temp_path, self.path)
+
+    def _load(self):
+        # Read the file on first use
+        if self.loaded:
+            return
+        self.loaded = True
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r") as cache_file:
+                records = json.load(cache_file)
+            for mail_id, command, description in records[-self.max_size:]:
+                self.entries[mail_id] = (command, description)
+        except (IOError, OSError, TypeError, ValueError) as error:
+            self.entries.clear()
+            if getattr(error, "errno", None) == errno.ENOENT:
+                return
+            if self.logger:
+                self.logger.warning("Discarding unreadable mailbox cache "
+                                    "%s. %s", self.path, str(error))
+
+
 class Message(object):
     """
-    Holds received messages in their json format
+    Holds received messages in their json format. Messages received as raw
+    payload bytes are only decoded when json is first read, so the network
+    thread does not have to.
     """
 
-    def __init__(self, topic, json_msg):
+    def __init__(self, topic, json_msg=None, payload=None):
         self.topic = topic
-        self.json = json_msg
+        self.payload = payload
+        self._json = json_msg
+
+    @property
+    def json(self):
+        """
+        The decoded message. Raises ValueError if the payload is not valid
+        JSON.
+        """
+        if self._json is None and self.payload is not None:
+            self._json = json.loads(self.payload.decode("utf-8"))
+            self.payload = None
+        return self._json
 
     def __str__(self):
         return json.dumps(self.json, indent=2, sort_keys=True)
@@ -268,62 +455,230 @@ class OutMessage(object):
         self.data = data
         self.out_id = out_id
 
+        # Time by which a reply is expected, in seconds since the epoch, and
+        # the number of times the message has been sent again
+        self.deadline = None
+        self.retries = 0
+
+        # Resolved with the status of the reply
+        self.future = futures.Future()
+
     def __str__(self):
         return self.description
 
 
-class OutTracker(dict):
+class OutTracker(object):
     """
-    Holds all sent messages that are waiting for a reply
+    Holds all sent messages that are waiting for a reply. Each payload is sent
+    on an integer topic id from 1 to max_topics, and its messages are kept in a
+    preallocated slot table indexed by topic id and command number. Topic ids
+    are reused oldest freed first, and allocating one waits for a reply to
+    free an id once max_topics payloads are in flight. Topics whose payload
+    was acknowledged by the MQTT broker are marked, as they are not
+    retransmitted by MQTT after reconnecting.
     """
 
-    def __init__(self):
-        super(OutTracker, self).__init__()
+    def __init__(self, max_topics=constants.DEFAULT_MAX_IN_FLIGHT):
+        self.max_topics = max_topics
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+
+        # Messages and number of outstanding replies of each topic id. Id 0 is
+        # the no reply topic and never allocated.
+        self.slots = [None] * (max_topics + 1)
+        self.pending = [0] * (max_topics + 1)
+        self.acked = [False] * (max_topics + 1)
+        self.topics = ["{:0>4}".format(topic_id)
+                       for topic_id in range(max_topics + 1)]
+        self.free_ids = deque(range(1, max_topics + 1))
+        self.count = 0
+
+        # MIDs are added after publishing, so the publish may already be
+        # complete. Those MIDs are remembered until they are added.
         self.mid_tracker = {}
+        self.mids_done = set()
+
+    def __len__(self):
+        return self.count
 
-    def add_message(self, message):
+    def add_messages(self, messages, timeout=None):
         """
-        Add a message
+        Allocate a topic id for a payload of messages, setting their out_id to
+        (topic id, command number). Waits up to timeout seconds for a free
+        topic id, returning None if there is none.
         """
 
-        self[message.out_id] = message
+        with self.not_full:
+            if not self.free_ids:
+                end_time = None if timeout is None else time() + timeout
+                while not self.free_ids:
+                    remaining = None
+                    if end_time is not None:
+                        remaining = end_time - time()
+                        if remaining <= 0:
+                            return None
+                    self.not_full.wait(remaining)
+            topic_id = self.free_ids.popleft()
+            for num, message in enumerate(messages):
+                message.out_id = (topic_id, num + 1)
+            self.slots[topic_id] = messages
+            self.pending[topic_id] = len(messages)
+            self.count += len(messages)
+            return topic_id
+
+    def add_mid(self, mid, topic_id):
+        """
+        Add an MID with the topic id it will send on
+        """
 
-    def add_mid(self, mid, topic):
+        with self.lock:
+            if mid in self.mids_done:
+                self.mids_done.discard(mid)
+                self.acked[topic_id] = True
+            else:
+                self.mid_tracker[mid] = topic_id
+
+    def get_message(self, topic_id, command_num):
+        """
+        Returns a message waiting for a reply, or None
+        """
+
+        with self.lock:
+            if 0 < topic_id <= self.max_topics and self.slots[topic_id]:
+                messages = self.slots[topic_id]
+                if 0 < command_num <= len(messages):
+                    return messages[command_num - 1]
+            return None
+
+    def messages(self):
         """
-        Add an MID with the topic it will send on
+        Returns a list of all messages waiting for a reply
         """
 
-        self.mid_tracker[mid] = topic
+        with self.lock:
+            return [message for messages in self.slots if messages
+                    for message in messages if message]
 
-    def pop_message(self, topic_num, cmd_num):
+    def pop_message(self, topic_id, command_num):
         """
         Remove a single message
         """
 
-        out_id = "{}-{}".format(topic_num, cmd_num)
-        try:
-            message = self.pop(out_id)
-        except KeyError:
-            raise KeyError("Message {} not found. May be a duplicate "
-                           "reply".format(out_id))
-        return message
+        with self.lock:
+            message = None
+            if 0 < topic_id <= self.max_topics and self.slots[topic_id]:
+                messages = self.slots[topic_id]
+                if 0 < command_num <= len(messages):
+                    message = messages[command_num - 1]
+                    messages[command_num - 1] = None
+            if message is None:
+                raise KeyError("Message {:0>4}-{} not found. May be a "
+                               "duplicate reply".format(topic_id, command_num))
+            self.count -= 1
+            self.pending[topic_id] -= 1
+            if self.pending[topic_id] == 0:
+                self._free(topic_id)
+            return message
+
+    def pop_expired(self, now):
+        """
+        Remove and return all messages whose deadline is before now
+        """
+
+        expired = []
+        with self.lock:
+            for topic_id, messages in enumerate(self.slots):
+                if not messages:
+                    continue
+                for index, message in enumerate(messages):
+                    if (message and message.deadline is not None and
+                            message.deadline < now):
+                        expired.append(message)
+                        messages[index] = None
+                        self.count -= 1
+                        self.pending[topic_id] -= 1
+                if self.pending[topic_id] == 0:
+                    self._free(topic_id)
+        return expired
+
+    def pop_acked(self):
+        """
+        Remove and return all messages of topics whose payload was
+        acknowledged
+        """
+
+        acked = []
+        with self.lock:
+            for topic_id, messages in enumerate(self.slots):
+                if messages and self.acked[topic_id]:
+                    acked.extend(message for message in messages if message)
+                    self.count -= self.pending[topic_id]
+                    self._free(topic_id)
+        return acked
 
     def pop_mid(self, mid):
         """
-        Retrieve the topic an MID is sending on
+        Retrieve the topic id an MID was sent on, marking its payload
+        acknowledged, or None if it has not been added yet
         """
 
-        return self.mid_tracker.pop(mid)
+        with self.lock:
+            topic_id = self.mid_tracker.pop(mid, None)
+            if topic_id is None:
+                self.mids_done.add(mid)
+            else:
+                self.acked[topic_id] = True
+            return topic_id
+
+    def postpone(self, seconds):
+        """
+        Push back the deadline of every message waiting for a reply
+        """
+
+        with self.lock:
+            for messages in self.slots:
+                for message in messages or ():
+                    if message and message.deadline is not None:
+                        message.deadline += seconds
+
+    def remove_topic(self, topic_id):
+        """
+        Stop waiting for replies to all messages of a topic id
+        """
+
+        with self.lock:
+            if self.slots[topic_id]:
+                self.count -= self.pending[topic_id]
+                self._free(topic_id)
+
+    def topic(self, topic_id):
+        """
+        Returns the topic string of a topic id
+        """
+
+        return self.topics[topic_id]
+
+    def _free(self, topic_id):
+        self.slots[topic_id] = None
+        self.pending[topic_id] = 0
+        self.acked[topic_id] = False
+        self.free_ids.append(topic_id)
+        self.not_full.notify()
 
 
 class Publish(object):
     """
-    Super Class for holding information about a pending publish
+    Super Class for holding information about a pending publish. The timestamp
+    is kept in seconds since the epoch and only formatted when sent. priority
+    selects the lane of the publish queue, lower is more urgent.
     """
 
+    priority = constants.PRIORITY_LOG
+    __slots__ = ("timestamp", "future")
+
     def __init__(self):
-        self.timestamp = datetime.utcnow().strftime(constants.TIME_FORMAT)
-        self.type = self.__class__.__name__
+        self.timestamp = time()
+        self.future = None
 
 
 class PublishAlarm(Publish):
@@ -331,6 +686,9 @@ class PublishAlarm(Publish):
     Holds information about an alarm
     """
 
+    priority = constants.PRIORITY_ALARM
+    __slots__ = ("name", "state", "message")
+
     def __init__(self, name, state, message=None):
         super(PublishAlarm, self).__init__()
         self.name = name
@@ -343,6 +701,9 @@ class PublishAttribute(Publish):
     Holds information about an attribute that is to be published
     """
 
+    priority = constants.PRIORITY_ATTRIBUTE
+    __slots__ = ("name", "value")
+
     def __init__(self, name, value):
         super(PublishAttribute, self).__init__()
         self.name = name
@@ -354,6 +715,10 @@ class PublishLocation(Publish):
     Holds location information
     """
 
+    priority = constants.PRIORITY_LOCATION
+    __slots__ = ("latitude", "longitude", "heading", "altitude",
+                 "speed", "accuracy", "fix_type")
+
     def __init__(self, latitude, longitude, heading=None, altitude=None,
                  speed=None, accuracy=None, fix_type=None):
         super(PublishLocation, self).__init__()
@@ -386,22 +751,329 @@ class PublishLog(Publish):
     Holds a log message to be sent to the Cloud
     """
 
+    priority = constants.PRIORITY_LOG
+    __slots__ = ("message",)
+
     def __init__(self, message):
         super(PublishLog, self).__init__()
         self.message = message
 
 
+class PublishQueue(object):
+    """
+    Queue of pending publishes holding at most maxsize publishes (0 for no
+    limit), with a separate lane for each priority. Lane 0 is the most urgent.
+    Lanes are drained in weighted round robin, taking up to weights[lane]
+    publishes from each lane per round.
+
+    When the queue is full, a new publish replaces the oldest publish of the
+    least urgent lane that is less urgent than it. Otherwise it is handled
+    according to policy:
+      block         wait up to timeout seconds for room, then reject it
+      drop_oldest   discard the oldest pending publish of its lane
+      drop_newest   reject it
+      sample        keep one in every sample publishes in place of the oldest
+                    pending publish of its lane, and reject the rest
+    Rejected and discarded publishes are counted in dropped, and publishes
+    that had to wait for room in blocked.
+    """
+
+    def __init__(self, maxsize=0, policy=constants.POLICY_BLOCK, timeout=0,
+                 sample=1, weights=None):
+        if policy not in constants.POLICIES:
+            raise ValueError("Unknown publish queue policy {}".format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.timeout = timeout
+        self.sample = max(int(sample), 1)
+        self.weights = [max(int(weight), 1) for weight in weights or [1]]
+        self.blocked = 0
+        self.dropped = 0
+        self.lanes = [deque() for _ in self.weights]
+        self.count = 0
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+        self.all_done = threading.Condition(self.mutex)
+        self.sample_count = 0
+
+        # Publishes queued and not yet marked done by task_done
+        self.unfinished = 0
+
+        # Number of pending publishes that wakes a wait in progress, and
+        # whether flush has been called since the last wait
+        self.notify_count = 1
+        self.flushing = False
+
+    def empty(self):
+        """
+        Returns True if there are no pending publishes
+        """
+
+        with self.mutex:
+            return self.count == 0
+
+    def flush(self):
+        """
+        End a wait in progress without waiting for the rest of its linger
+        """
+
+        with self.mutex:
+            self.flushing = True
+            self.not_empty.notify_all()
+
+    def free(self):
+        """
+        Returns the room left in the queue, or None if it has no limit
+        """
+
+        if not self.maxsize:
+            return None
+        with self.mutex:
+            return max(self.maxsize - self.count, 0)
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return the oldest pending publish of the most urgent lane.
+        Raises queue.Empty if there is none.
+        """
+
+        with self.not_empty:
+            if block:
+                end_time = None if timeout is None else time() + timeout
+                while self.count == 0:
+                    remaining = None
+                    if end_time is not None:
+                        remaining = end_time - time()
+                        if remaining <= 0:
+                            break
+                    self.not_empty.wait(remaining)
+            if self.count == 0:
+                raise queue.Empty
+            for lane in self.lanes:
+                if lane:
+                    self.count -= 1
+                    self.not_full.notify()
+                    return lane.popleft()
+
+    def get_many(self, limit=0):
+        """
+        Remove and return up to limit pending publishes (0 for all), taken from
+        the lanes in weighted round robin
+        """
+
+        items = []
+        with self.mutex:
+            if not limit or limit > self.count:
+                limit = self.count
+            while len(items) < limit:
+                for lane, weight in zip(self.lanes, self.weights):
+                    take = min(weight, len(lane), limit - len(items))
+                    for _ in range(take):
+                        items.append(lane.popleft())
+            self.count -= len(items)
+            self.not_full.notify(len(items))
+        return items
+
+    def join(self, timeout=None):
+        """
+        Wait up to timeout seconds (None for no limit) until every publish
+        queued has been marked done with task_done. Returns True if they have.
+        """
+
+        with self.all_done:
+            end_time = None if timeout is None else time() + timeout
+            while self.unfinished:
+                remaining = None
+                if end_time is not None:
+                    remaining = end_time - time()
+                    if remaining <= 0:
+                        return False
+                self.all_done.wait(remaining)
+            return True
+
+    def put(self, item, priority=0, block=True, evicted=None):
+        """
+        Add a publish to the lane of priority, making room according to the
+        policy if the queue is full. Publishes discarded to make room are
+        appended to the evicted list, if one is given. Returns False if the
+        publish was rejected.
+        """
+
+        priority = min(max(priority, 0), len(self.lanes) - 1)
+        if evicted is None:
+            evicted = []
+        with self.not_full:
+            if self.maxsize and self.count >= self.maxsize:
+                if self._evict(priority + 1, evicted):
+                    pass
+                elif self.policy == constants.POLICY_BLOCK:
+                    if block and self.timeout > 0:
+                        self.blocked += 1
+                        end_time = time() + self.timeout
+                        while self.count >= self.maxsize:
+                            remaining = end_time - time()
+                            if remaining <= 0:
+                                break
+                            self.not_full.wait(remaining)
+                    if self.count >= self.maxsize:
+                        self.dropped += 1
+                        return False
+                elif self.policy == constants.POLICY_DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif self.policy == constants.POLICY_SAMPLE:
+                    self.sample_count += 1
+                    if (self.sample_count < self.sample or
+                            not self._evict(priority, evicted)):
+                        self.dropped += 1
+                        return False
+                    self.sample_count = 0
+                elif not self._evict(priority, evicted):
+                    self.dropped += 1
+                    return False
+            self.lanes[priority].append(item)
+            self.count += 1
+            self.unfinished += 1
+            if self.count == 1 or self.count >= self.notify_count:
+                self.not_empty.notify_all()
+            return True
+
+    def qsize(self):
+        """
+        Returns the number of pending publishes
+        """
+
+        with self.mutex:
+            return self.count
+
+    def stats(self):
+        """
+        Returns a dict of the queue size, the size of each lane and the blocked
+        and dropped counts
+        """
+
+        with self.mutex:
+            return {"size":self.count, "maxsize":self.maxsize,
+                    "lanes":[len(lane) for lane in self.lanes],
+                    "blocked":self.blocked, "dropped":self.dropped}
+
+    def task_done(self, count=1):
+        """
+        Mark count publishes taken from the queue as done
+        """
+
+        with self.mutex:
+            if count > self.unfinished:
+                raise ValueError("task_done() called too many times")
+            self.unfinished -= count
+            if not self.unfinished:
+                self.all_done.notify_all()
+
+    def wait(self, count=1, linger=0, timeout=None):
+        """
+        Wait up to timeout seconds for a pending publish, then up to linger
+        seconds more until count publishes are pending or flush is called.
+        Returns the number of pending publishes.
+        """
+
+        with self.not_empty:
+            self.notify_count = max(count, 1)
+            end_time = None if timeout is None else time() + timeout
+            while self.count == 0 and not self.flushing:
+                remaining = None
+                if end_time is not None:
+                    remaining = end_time - time()
+                    if remaining <= 0:
+                        break
+                self.not_empty.wait(remaining)
+
+            if self.count and linger > 0:
+                end_time = time() + linger
+                while self.count < count and not self.flushing:
+                    remaining = end_time - time()
+                    if remaining <= 0:
+                        break
+                    self.not_empty.wait(remaining)
+            self.flushing = False
+            return self.count
+
+    def _evict(self, priority, evicted):
+        # Discard the oldest publish of the least urgent non-empty lane, no
+        # more urgent than priority, into evicted
+        for lane in reversed(self.lanes[priority:]):
+            if lane:
+                evicted.append(lane.popleft())
+                self.count -= 1
+                self.unfinished -= 1
+                self.dropped += 1
+                return True
+        return False
+
+
 class PublishTelemetry(Publish):
     """
     Holds information about telemetry that is to be published
     """
 
+    priority = constants.PRIORITY_TELEMETRY
+    __slots__ = ("name", "value")
+
     def __init__(self, name, value):
         super(PublishTelemetry, self).__init__()
         self.name = name
         self.value = value
 
 
+class PublishTelemetryBlock(Publish):
+    """
+    Holds a block of telemetry samples for one key that is to be published.
+    Each value has its own timestamp, or the values are spaced interval
+    seconds apart starting at start (by default, so that the last value is at
+    the current time).
+    """
+
+    priority = constants.PRIORITY_TELEMETRY
+    __slots__ = ("name", "values", "timestamps", "interval")
+
+    def __init__(self, name, values, timestamps=None, interval=None,
+                 start=None):
+        super(PublishTelemetryBlock, self).__init__()
+        self.name = name
+        # Copy buffers (array.array, NumPy arrays) into plain lists once, so
+        # they can be serialised directly and reused by the caller
+        if hasattr(values, "tolist"):
+            self.values = values.tolist()
+        else:
+            self.values = list(values)
+        if timestamps is not None:
+            if hasattr(timestamps, "tolist"):
+                timestamps = timestamps.tolist()
+            else:
+                timestamps = list(timestamps)
+        self.timestamps = timestamps
+        self.interval = interval
+        if interval is not None:
+            if start is None:
+                start = self.timestamp - interval * (len(self.values) - 1)
+            self.timestamp = start
+
+    def times(self):
+        """
+        Returns an iterable of the time of each value. Times spaced by interval
+        are only calculated as they are read.
+        """
+
+        if self.timestamps is not None:
+            return self.timestamps
+        if self.interval is not None:
+            start = self.timestamp
+            interval = self.interval
+            return (start + index * interval
+                    for index in range(len(self.values)))
+        return [self.timestamp] * len(self.values)
+
+
 class Work(object):
     """
     Holds information about work that needs to be completed
@@ -410,5 +1082,29 @@ class Work(object):
     def __init__(self, work_type, data):
         self.type = work_type
         self.data = data
+        # Time the work was queued, set by its worker pool
+        self.queued = None
+
+
+class WorkQueue(queue.Queue):
+    """
+    Queue of pending work, whose join can time out
+    """
 
+    def join(self, timeout=None, pending=0):
+        """
+        Wait up to timeout seconds (None for no limit) until at most pending
+        items taken from the queue have not been marked done with task_done.
+        Returns True if they have.
+        """
 
+        with self.all_tasks_done:
+            end_time = None if timeout is None else time() + timeout
+            while self.unfinished_tasks > pending:
+                remaining = None
+                if end_time is not None:
+                    remaining = end_time - time()
+                    if remaining <= 0:
+                        return False
+                self.all_tasks_done.wait(remaining)
+            return True
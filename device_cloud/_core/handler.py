@@ -15,7 +15,7 @@
 This module handles all the underlying functionality of the Client
 """
 
-import json
+import itertools
 import logging
 import os
 import random
@@ -30,26 +30,50 @@ except ImportError:
     pass
 
 import ssl
-import sys
 import threading
 from binascii import crc32
+from concurrent import futures
 from datetime import datetime
-from datetime import timedelta
 from time import sleep
+from time import time
 import requests
 import paho.mqtt.client as mqttlib
 
 from device_cloud._core import constants
 from device_cloud._core import defs
+from device_cloud._core import spool
+from device_cloud._core import telemetry
 from device_cloud._core import tr50
+from device_cloud._core import workers
 from device_cloud._core.tr50 import TR50Command
 
 original_socket = socket.socket
 
-if sys.version_info.major == 2:
-    import Queue as queue
-else:
-    import queue
+
+# TR50 commands sent for each publish type
+NO_REPLY_COMMANDS = {
+    "alarm": [TR50Command.alarm_publish],
+    "attribute": [TR50Command.attribute_publish],
+    "location": [TR50Command.location_publish],
+    "log": [TR50Command.log_publish],
+    "telemetry": [TR50Command.property_publish, TR50Command.property_batch]
+}
+
+# TR50 commands that can safely be sent again if their reply times out
+RETRY_COMMANDS = set([
+    TR50Command.alarm_publish,
+    TR50Command.attribute_current,
+    TR50Command.attribute_publish,
+    TR50Command.diag_echo,
+    TR50Command.diag_ping,
+    TR50Command.diag_time,
+    TR50Command.file_get,
+    TR50Command.location_publish,
+    TR50Command.mailbox_check,
+    TR50Command.property_batch,
+    TR50Command.property_publish,
+    TR50Command.thing_find
+])
 
 
 def status_string(error_code):
@@ -156,37 +180,181 @@ class Handler(object):
         # data
         self.callbacks = defs.Callbacks()
 
-        # Connection state of the Client
+        # Connection state of the Client, and a condition notified whenever it
+        # changes
+        self.state_changed = threading.Condition()
         self.state = constants.STATE_DISCONNECTED
 
         # Track last time the app was connected so keep alive can time out
         self.last_connected = datetime.utcnow()
 
-        # Lock for thread safety
-        self.lock = threading.Lock()
-
-        # Queue for any pending publishes (number, string, location, etc.)
-        self.publish_queue = queue.Queue()
+        # Queue for any pending publishes (number, string, location, etc.),
+        # bounded so a slow link cannot grow it without limit
+        try:
+            self.publish_queue = defs.PublishQueue(
+                self.config.publish_queue_size or 0,
+                self.config.publish_queue_policy or
+                constants.DEFAULT_PUBLISH_QUEUE_POLICY,
+                self.config.publish_queue_timeout or 0,
+                self.config.publish_queue_sample or 1,
+                self.config.publish_priority_weights)
+        except ValueError as error:
+            self.logger.error(str(error))
+            raise
+
+        # Disk spool for publishes made while disconnected, and the last time
+        # it was drained
+        self.spool = None
+        self.last_drain = time()
+        if self.config.publish_spool:
+            spool_path = os.path.join(self.config.config_dir,
+                                      constants.SPOOL_FILE.format(
+                                          self.config.app_id))
+            try:
+                self.spool = spool.PublishSpool(spool_path,
+                                                self.config.spool_max_size,
+                                                self.config.spool_max_age)
+            except Exception as error:
+                self.logger.error("Failed to open publish spool %s. %s",
+                                  spool_path, str(error))
+                raise IOError("Failed to open publish spool "
+                              "{}".format(spool_path))
+            if len(self.spool) > 0:
+                self.logger.info("%d spooled publishes waiting to be sent",
+                                 len(self.spool))
+
+        # Compression filters for telemetry keys
+        self.telemetry_filters = {}
+        compression = self.config.telemetry_compression or {}
+        for name, settings in compression.items():
+            try:
+                telemetry_filter = telemetry.create_filter(settings)
+                self.telemetry_filters[name] = telemetry_filter
+            except (TypeError, ValueError) as error:
+                self.logger.error("Invalid compression for telemetry %s. %s",
+                                  name, str(error))
+                raise ValueError("Invalid compression for telemetry "
+                                 "{}".format(name))
+
+        # Window aggregation for telemetry keys
+        self.telemetry_aggregators = {}
+        aggregation = self.config.telemetry_aggregation or {}
+        for name, settings in aggregation.items():
+            try:
+                aggregator = telemetry.create_aggregator(settings)
+                self.telemetry_aggregators[name] = aggregator
+            except (TypeError, ValueError) as error:
+                self.logger.error("Invalid aggregation for telemetry %s. %s",
+                                  name, str(error))
+                raise ValueError("Invalid aggregation for telemetry "
+                                 "{}".format(name))
+
+        # Attribute and alarm names only published when their value changes,
+        # and the last value published for each of them
+        self.on_change = set(self.config.publish_on_change or [])
+        self.last_published = {}
 
         # Dicts to track which messages sent out have not received replies. Also
         # stores any actions to be taken when the reply is received.
-        self.reply_tracker = defs.OutTracker()
-        self.no_reply = []
-
-        # Counter to allow every message to be sent on a unique topic
-        self.topic_counter = 1
+        self.reply_tracker = defs.OutTracker(self.config.max_in_flight or
+                                             constants.DEFAULT_MAX_IN_FLIGHT)
+
+        # Track when replies were last checked for timeouts, and how many
+        # commands were sent again or expired without a reply
+        self.last_sweep = time()
+        self.replies_retried = 0
+        self.replies_expired = 0
+
+        # TR50 commands of publish types that are sent at QoS 0 without
+        # tracking their replies. The Cloud still sends the replies.
+        self.no_reply = set()
+        for pub_type in self.config.publish_no_reply or []:
+            commands = NO_REPLY_COMMANDS.get(pub_type)
+            if commands is None:
+                self.logger.error("Unknown publish type %s in "
+                                  "publish_no_reply", pub_type)
+                raise ValueError("Unknown publish type {} in "
+                                 "publish_no_reply".format(pub_type))
+            self.no_reply.update(commands)
+
+        # Mailbox paging. Mail ids of actions in progress, whether a mailbox
+        # check is waiting for its reply, and whether more mail may be waiting
+        # to be fetched.
+        self.mailbox_lock = threading.Lock()
+        self.mailbox_actions = set()
+        self.mailbox_checking = False
+        self.mailbox_pending = False
+
+        # A watermark of a full page or more would never hold back the next
+        # page, so it is kept below the page size
+        page_size = self.config.mailbox_page_size
+        watermark = self.config.mailbox_watermark
+        if page_size and not 0 < watermark < page_size:
+            self.config.mailbox_watermark = max(page_size - 1, 1)
+            self.logger.warning("mailbox_watermark %s must be between 1 and "
+                                "mailbox_page_size %s, using %s", watermark,
+                                page_size, self.config.mailbox_watermark)
+
+        # Acks of recently executed mailbox actions, to answer actions that
+        # are delivered again without executing them twice
+        self.mailbox_cache = None
+        if self.config.mailbox_cache_size:
+            cache_path = os.path.join(self.config.config_dir,
+                                      constants.MAILBOX_CACHE_FILE.format(
+                                          self.config.app_id))
+            self.mailbox_cache = defs.MailCache(cache_path,
+                                                self.config.mailbox_cache_size,
+                                                self.logger)
+
+        # Counter of sends, to log only a sample of payloads
+        self.payload_counter = itertools.count()
 
         # Flag for notifying client to exit
         self.to_quit = True
 
-        # Thread trackers. Main thread for handling MQTT loop, and worker
-        # threads for everything else.
+        # Thread tracker. Main thread for handling MQTT loop, and worker pools
+        # for everything else.
         self.main_thread = None
-        self.worker_threads = []
 
-        # Queue to track any pending work (parsing messages, actions,
-        # publishing, file transfer, etc.)
-        self.work_queue = queue.Queue()
+        # Publish thread, sends pending publishes as soon as they are ready.
+        # When an event loop sends them instead, publish_notify is called with
+        # each publish queued.
+        self.publish_thread = None
+        self.publish_notify = None
+
+        # Pools of worker threads, each with its own queue of pending work, so
+        # that file transfers and actions cannot hold up handling replies
+        self.work_pools = {}
+        for name, size, queue_size in [
+                ("message", self.config.thread_count,
+                 self.config.message_queue_size),
+                ("action", self.config.action_thread_count,
+                 self.config.action_queue_size),
+                ("transfer", self.config.transfer_thread_count,
+                 self.config.transfer_queue_size)]:
+            self.work_pools[name] = workers.WorkerPool(
+                name, self.handle_work, size, queue_size,
+                self.config.worker_min_threads, self.config.worker_wait_target,
+                self.config.worker_idle_timeout, self.config.loop_time,
+                self.logger)
+
+    def abandon_replies(self):
+        """
+        On disconnect, show all messages that never received replies and fail
+        their futures
+        """
+
+        if len(self.reply_tracker) > 0:
+            self.logger.error("These messages never received a reply:")
+            for message in self.reply_tracker.messages():
+                self.logger.error(".... %04d-%d - %s", message.out_id[0],
+                                  message.out_id[1], message.description)
+                defs.set_result(message.future, constants.STATUS_FAILURE)
+                if (isinstance(message.data, defs.FileTransfer) and
+                        message.data.status is None):
+                    message.data.status = constants.STATUS_FAILURE
+
+        return constants.STATUS_SUCCESS
 
     def action_deregister(self, action_name):
         """
@@ -213,6 +381,7 @@ class Handler(object):
                                        "{} {}: \"{}\"".format(request_id,
                                                               error_code,
                                                               error_message))
+        self.cache_ack(request_id, cmd, message.description)
         return self.send(message)
 
     def action_progress_update(self, request_id, message):
@@ -260,59 +429,175 @@ class Handler(object):
 
         return status
 
-    def connect(self, timeout=0):
+    def cache_ack(self, mail_id, command, description):
         """
-        Connect to MQTT and start main thread
+        Remember the ack sent for a mailbox action, so it can be sent again if
+        the action is delivered again
         """
 
-        self.to_quit = False
-        status = constants.STATUS_FAILURE
-        result = -1
+        if self.mailbox_cache is not None:
+            try:
+                self.mailbox_cache.put(mail_id, command, description)
+            except (IOError, OSError, TypeError) as error:
+                self.logger.warning("Failed to save mailbox cache. %s",
+                                    str(error))
 
-        # Ensure we have a host and port to connect to
-        if not self.config.cloud.host or not self.config.cloud.port:
-            self.logger.error("Missing host or port from configuration")
-            status = constants.STATUS_BAD_PARAMETER
+    def check_mailbox(self):
+        """
+        Request the next page of the mailbox. If a check is already waiting
+        for its reply, or mailbox_watermark actions are in progress, it is
+        requested once that is no longer the case.
+        """
+
+        watermark = self.config.mailbox_watermark
+        with self.mailbox_lock:
+            self.mailbox_pending = True
+            if self.mailbox_checking or (
+                    watermark and len(self.mailbox_actions) >= watermark):
+                return constants.STATUS_SUCCESS
+            self.mailbox_checking = True
+            self.mailbox_pending = False
+
+        mailbox_check = tr50.create_mailbox_check(
+            auto_complete=False, limit=self.config.mailbox_page_size or None)
+        to_send = defs.OutMessage(mailbox_check, "Mailbox Check")
+        status = self.send(to_send)
+        if status != constants.STATUS_SUCCESS:
+            with self.mailbox_lock:
+                self.mailbox_checking = False
+        return status
+
+    def coalesce_publishes(self, to_publish):
+        """
+        Drop publishes that do not change the final state in the Cloud. With
+        publish_coalesce set, only the newest attribute and alarm of each name
+        are kept. Attributes and alarms named in publish_on_change are dropped
+        if their value matches the last one published.
+        """
+
+        if self.config.publish_coalesce:
+            # Walk backwards, skipping anything older than a publish of the
+            # same name that is already kept
+            seen = set()
+            kept = []
+            for pub in reversed(to_publish):
+                pub_class = pub.__class__
+                if (pub_class is defs.PublishAttribute or
+                        pub_class is defs.PublishAlarm):
+                    key = (pub_class, pub.name)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                kept.append(pub)
+            kept.reverse()
+            to_publish = kept
+
+        if self.on_change:
+            kept = []
+            for pub in to_publish:
+                key = None
+                if pub.__class__ is defs.PublishAttribute:
+                    key = (defs.PublishAttribute, pub.name)
+                    value = pub.value
+                elif pub.__class__ is defs.PublishAlarm:
+                    key = (defs.PublishAlarm, pub.name)
+                    value = (pub.state, pub.message)
+
+                if key and pub.name in self.on_change:
+                    if (key in self.last_published and
+                            self.last_published[key] == value):
+                        continue
+                    self.last_published[key] = value
+                kept.append(pub)
+            to_publish = kept
+
+        return to_publish
+
+    def complete_action(self, action_request, action_result, error=None):
+        """
+        Report the result of an action callback, or the error it raised, to
+        the Cloud
+        """
+
+        result_code = -1
+        result_args = {"mail_id":action_request.request_id}
+
+        if error is not None:
+            # Error with action execution. Might not have been registered.
+            self.logger.error("Action %s execution failed", action_request.name)
+            self.logger.error(".... %s", str(error))
+            result_code = constants.STATUS_FAILURE
+            result_args["error_message"] = "ERROR: {}".format(str(error))
+            if action_request.name not in self.callbacks:
+                result_code = constants.STATUS_NOT_FOUND
 
         else:
-            current_time = datetime.utcnow()
-            end_time = current_time + timedelta(seconds=timeout)
-            self.state = constants.STATE_CONNECTING
+            # Action execution did not raise an error. Handle returning a
+            # tuple or just a status code
+            if action_result.__class__.__name__ == "tuple":
+                result_code = action_result[0]
+                if len(action_result) >= 2:
+                    result_args["error_message"] = str(action_result[1])
+                if len(action_result) >= 3:
+                    result_args["params"] = action_result[2]
+            else:
+                result_code = action_result
 
-            # Start a secure connection if using a secure port and the cert file
-            # is available
-            if self.config.cloud.port in constants.SECURE_PORTS:
-                if self.config.validate_cloud_cert is False:
-                    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-                    context.verify_mode = ssl.CERT_NONE
-                    context.check_hostname = False
-                    self.mqtt.tls_set_context(context)
-                elif not self.config.ca_bundle_file:
-                    self.logger.error("Missing certificate bundle from configuration")
-                    status = constants.STATUS_BAD_PARAMETER
-                elif not os.path.isfile(self.config.ca_bundle_file):
-                    self.logger.error("Certificate bundle not found")
-                    status = constants.STATUS_NOT_FOUND
-                else:
-                    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-                    context.load_verify_locations(cafile=self.config.ca_bundle_file)
-                    context.verify_mode = ssl.CERT_REQUIRED
-                    context.check_hostname = True
-                    self.mqtt.tls_set_context(context)
+            if not is_valid_status(result_code):
+                # Returned 'status' is not a valid status
+                error_string = ("Invalid return status: " +
+                                str(result_code))
+                self.logger.error(error_string)
+                result_code = constants.STATUS_BAD_PARAMETER
+                result_args["error_message"] = "ERROR: " + error_string
 
+        # Return status to Cloud
+        # Check for invoked status.  If so, return mail box update not
+        # ack.  Ack is the final notification.  This breaks triggers
+        # etc because it doesn't update the status.
+        result_args["error_code"] = tr50.translate_error_code(result_code)
+        if result_code == constants.STATUS_INVOKED:
+                update_args = {"mail_id":action_request.request_id}
+                update_args["message"] = "Invoked"
+                mailbox_ack = tr50.create_mailbox_update(**update_args)
+        else:
+                mailbox_ack = tr50.create_mailbox_ack(**result_args)
 
-            # status != bad_parameter or not_found
-            if status == constants.STATUS_FAILURE:
-                # Start MQTT connection
-                try:
-                    result = self.mqtt.connect(self.config.cloud.host,
-                                               self.config.cloud.port, 60)
-                except Exception as error:
-                    # socket.gaierror or ssl.SSLError
-                    self.state = constants.STATE_DISCONNECTED
-                    self.logger.error(str(error))
+        message_desc = "Action Complete \"{}\"".format(action_request.name)
+        message_desc += " result : {}({})".format(result_code,
+                                                  status_string(result_code))
+        if result_args.get("error_message"):
+            message_desc += " \"{}\"".format(result_args["error_message"])
+        if result_args.get("params"):
+            message_desc += " \"{}\"".format(str(result_args["params"]))
+        message = defs.OutMessage(mailbox_ack, message_desc)
+        if result_code != constants.STATUS_INVOKED:
+            # Only the final ack answers an action delivered again
+            self.cache_ack(action_request.request_id, mailbox_ack,
+                           message_desc)
+        status = self.send(message)
 
-        if result == 0:
+        # Fetch more of the mailbox if it was waiting on this action
+        with self.mailbox_lock:
+            self.mailbox_actions.discard(action_request.request_id)
+            pending = self.mailbox_pending
+        if pending:
+            self.check_mailbox()
+
+        return status
+
+    def connect(self, timeout=0):
+        """
+        Connect to MQTT and start main thread
+        """
+
+        # The spool is closed each time the main loop ends
+        if self.spool is not None:
+            self.spool.open()
+
+        status = self.mqtt_connect()
+
+        if status == constants.STATUS_SUCCESS:
             # Successful MQTT connection
             self.logger.info("Connecting...")
 
@@ -321,14 +606,9 @@ class Handler(object):
             self.main_thread = threading.Thread(target=self.main_loop)
             self.main_thread.start()
 
-            # Wait for cloud connection
-            while ((timeout == 0 or current_time < end_time) and
-                   self.state == constants.STATE_CONNECTING):
-                sleep(0.1)
-                current_time = datetime.utcnow()
-
-            # Still connecting, timed out
-            if self.state == constants.STATE_CONNECTING:
+            # Wait for cloud connection. Still connecting, timed out.
+            if (self.wait_state(constants.STATE_CONNECTING, timeout) ==
+                    constants.STATE_CONNECTING):
                 self.logger.error("Connection timed out")
                 status = constants.STATUS_TIMED_OUT
 
@@ -337,15 +617,16 @@ class Handler(object):
             status = constants.STATUS_SUCCESS
 
             # Start worker threads if we have successfully connected
-            for _ in range(self.config.thread_count):
-                self.worker_threads.append(threading.Thread(
-                    target=self.handle_work_loop))
-            for thread in self.worker_threads:
-                thread.start()
+            for pool in self.work_pools.values():
+                pool.start()
+            self.publish_thread = threading.Thread(target=self.publish_loop)
+            self.publish_thread.start()
 
         else:
             # Not connected. Stop main loop.
             self.logger.error("Failed to connect")
+            if status == constants.STATUS_SUCCESS:
+                status = constants.STATUS_FAILURE
             self.to_quit = True
             self.state = constants.STATE_DISCONNECTED
             if self.main_thread:
@@ -360,105 +641,116 @@ class Handler(object):
         Stop threads and shut down MQTT client
         """
 
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=timeout)
+        end_time = time() + timeout
+
+        def remaining():
+            # Time left of timeout, None if there is no limit
+            if timeout == 0:
+                return None
+            return max(end_time - time(), 0)
+
+        self.flush_telemetry()
 
         # Publish any data that was queued before disconnecting
-        if not self.publish_queue.empty():
-            self.queue_work(defs.Work(constants.WORK_PUBLISH, None))
+        self.publish_queue.flush()
 
-        # Wait for pending work that has not been dealt with
+        # Wait for pending work and publishes that have not been dealt with.
+        # Work in progress on this thread, such as an action that
+        # disconnects, is not waited for.
         self.logger.info("Disconnecting...")
-        while ((timeout == 0 or current_time < end_time) and
-               not self.work_queue.empty()):
-            sleep(0.1)
-            current_time = datetime.utcnow()
+        for pool in self.work_pools.values():
+            pool.wait(remaining(), 1 if pool.is_worker() else 0)
+        if self.publish_thread:
+            self.publish_queue.join(remaining())
 
         # Optionally wait for any outstanding replies.
         if wait_for_replies and self.is_connected():
             self.logger.info("Waiting for replies...")
-            while ((timeout == 0 or current_time < end_time) and
-                   len(self.reply_tracker) != 0):
-                sleep(0.1)
-                current_time = datetime.utcnow()
+            futures.wait([message.future for message in
+                          self.reply_tracker.messages()], remaining())
 
         self.to_quit = True
         #TODO: Kill any hanging threads
-        if threading.current_thread() not in self.worker_threads:
+        if not self.is_worker():
             if self.main_thread:
                 self.main_thread.join()
                 self.main_thread = None
 
         return constants.STATUS_SUCCESS
 
+    def drain_spool(self):
+        """
+        Move spooled publishes back into the publish queue, no faster than
+        spool_drain_rate publishes per second
+        """
+
+        now = time()
+        rate = self.config.spool_drain_rate
+        limit = int((now - self.last_drain) * rate)
+        if rate and limit < 1:
+            return constants.STATUS_SUCCESS
+        # Don't allow more than a second's worth to build up, or more than
+        # the publish queue has room for
+        limit = min(limit, rate) if rate else len(self.spool)
+        free = self.publish_queue.free()
+        if free is not None:
+            limit = min(limit, free)
+        self.last_drain = now
+
+        ids = []
+        for spool_id, pub in self.spool.get(limit):
+            if self.queue_publish(pub) != constants.STATUS_SUCCESS:
+                break
+            ids.append(spool_id)
+        self.spool.remove(ids)
+        if ids and len(self.spool) == 0:
+            self.logger.info("Publish spool drained")
+        return constants.STATUS_SUCCESS
+
+    def expire_reply(self, message):
+        """
+        Give up on the reply to a message, failing its future and any file
+        transfer or mailbox check waiting on it with STATUS_TIMED_OUT
+        """
+
+        self.replies_expired += 1
+        defs.set_result(message.future, constants.STATUS_TIMED_OUT)
+        if message.command.get("command") == TR50Command.mailbox_check:
+            self.mailbox_checked(0, False)
+        if isinstance(message.data, defs.FileTransfer):
+            message.data.status = constants.STATUS_TIMED_OUT
+            message.data.finish()
+
+    def flush_telemetry(self):
+        """
+        Release any telemetry held back by aggregation or compression
+        """
+
+        for name, aggregator in self.telemetry_aggregators.items():
+            self.queue_summaries(name, aggregator.flush())
+        for name, telemetry_filter in self.telemetry_filters.items():
+            self.queue_points(name, telemetry_filter.flush())
+        return constants.STATUS_SUCCESS
+
     def handle_action(self, action_request):
         """
         Handle action execution requests from Cloud
         """
 
-        result_code = -1
-        result_args = {"mail_id":action_request.request_id}
         action_result = None
-        action_failed = False
+        error = None
 
         try:
             # Execute callback
             action_result = self.callbacks.execute_action(action_request)
 
-        except Exception as error:
+        except Exception as err:
             # Error with action execution. Might not have been registered.
-            action_failed = True
-            self.logger.error("Action %s execution failed", action_request.name)
-            self.logger.error(".... %s", str(error))
-            result_code = constants.STATUS_FAILURE
-            result_args["error_message"] = "ERROR: {}".format(str(error))
-            if action_request.name not in self.callbacks:
-                result_code = constants.STATUS_NOT_FOUND
-            else:
+            error = err
+            if action_request.name in self.callbacks:
                 self.logger.exception("Exception:")
 
-        # Action execution did not raise an error
-        if not action_failed:
-            # Handle returning a tuple or just a status code
-            if action_result.__class__.__name__ == "tuple":
-                result_code = action_result[0]
-                if len(action_result) >= 2:
-                    result_args["error_message"] = str(action_result[1])
-                if len(action_result) >= 3:
-                    result_args["params"] = action_result[2]
-            else:
-                result_code = action_result
-
-            if not is_valid_status(result_code):
-                # Returned 'status' is not a valid status
-                error_string = ("Invalid return status: " +
-                                str(result_code))
-                self.logger.error(error_string)
-                result_code = constants.STATUS_BAD_PARAMETER
-                result_args["error_message"] = "ERROR: " + error_string
-
-        # Return status to Cloud
-        # Check for invoked status.  If so, return mail box update not
-        # ack.  Ack is the final notification.  This breaks triggers
-        # etc because it doesn't update the status.
-        result_args["error_code"] = tr50.translate_error_code(result_code)
-        if result_code == constants.STATUS_INVOKED:
-                update_args = {"mail_id":action_request.request_id}
-                update_args["message"] = "Invoked"
-                mailbox_ack = tr50.create_mailbox_update(**update_args)
-        else:
-                mailbox_ack = tr50.create_mailbox_ack(**result_args)
-
-        message_desc = "Action Complete \"{}\"".format(action_request.name)
-        message_desc += " result : {}({})".format(result_code,
-                                                  status_string(result_code))
-        if result_args.get("error_message"):
-            message_desc += " \"{}\"".format(result_args["error_message"])
-        if result_args.get("params"):
-            message_desc += " \"{}\"".format(str(result_args["params"]))
-        message = defs.OutMessage(mailbox_ack, message_desc)
-        status = self.send(message)
-        return status
+        return self.complete_action(action_request, action_result, error)
 
     def handle_file_download(self, download):
         """
@@ -603,17 +895,34 @@ class Handler(object):
 
         status = constants.STATUS_NOT_SUPPORTED
 
-        msg_json = mqtt_message.json
+        # Decode the payload
+        try:
+            msg_json = mqtt_message.json
+        except ValueError as error:
+            self.logger.error("Failed to parse message on topic \"%s\". %s",
+                              mqtt_message.topic, str(error))
+            return constants.STATUS_PARSE_ERROR
+        self.logger.debug("Received message on topic \"%s\"\n%s",
+                          mqtt_message.topic, defs.LazyJson(msg_json))
+
         if "notify/" in mqtt_message.topic:
             # Received a notification
             if mqtt_message.topic[len("notify/"):] == "mailbox_activity":
                 # Mailbox activity, send a request to check the mailbox
                 self.logger.info("Recevied notification of mailbox activity")
-                mailbox_check = tr50.create_mailbox_check(auto_complete=False)
-                to_send = defs.OutMessage(mailbox_check, "Mailbox Check")
-                self.send(to_send)
+                self.check_mailbox()
                 status = constants.STATUS_SUCCESS
 
+        elif mqtt_message.topic == "reply/" + constants.NO_REPLY_TOPIC:
+            # Received replies to untracked commands, only failures are logged
+            for command_num in msg_json:
+                reply = msg_json[command_num]
+                if not reply.get("success"):
+                    self.logger.error("Received failure for untracked "
+                                      "command %s", command_num)
+                    self.logger.error(".... %s", str(reply))
+            status = constants.STATUS_SUCCESS
+
         elif "reply/" in mqtt_message.topic:
             # Received a reply to a previous message
             topic_num = mqtt_message.topic[len("reply/"):]
@@ -622,15 +931,12 @@ class Handler(object):
 
                 # Retrieve the sent message that this is a reply for, removing
                 # it from being tracked
-                self.lock.acquire()
                 try:
-                    sent_message = self.reply_tracker.pop_message(topic_num,
-                                                                  command_num)
-                except KeyError as error:
-                    self.logger.error(error.message)
+                    sent_message = self.reply_tracker.pop_message(
+                        int(topic_num), int(command_num))
+                except (KeyError, ValueError) as error:
+                    self.logger.error(str(error))
                     continue
-                finally:
-                    self.lock.release()
                 sent_command_type = sent_message.command.get("command")
 
                 # Log success status of reply
@@ -642,6 +948,15 @@ class Handler(object):
                                       topic_num, command_num, sent_message)
                     self.logger.error(".... %s", str(reply))
 
+                # Resolve the future of the sent message
+                if reply.get("success"):
+                    reply_status = constants.STATUS_SUCCESS
+                elif -90008 in reply.get("errorCodes", []):
+                    reply_status = constants.STATUS_NOT_FOUND
+                else:
+                    reply_status = constants.STATUS_FAILURE
+                defs.set_result(sent_message.future, reply_status)
+
                 # Check what kind of message this is a reply to
                 if sent_command_type == TR50Command.file_get:
                     # Recevied a reply for a file download request
@@ -652,7 +967,8 @@ class Handler(object):
                         file_transfer.file_id = file_id
                         file_transfer.file_checksum = file_checksum
                         work = defs.Work(constants.WORK_DOWNLOAD, file_transfer)
-                        self.queue_work(work)
+                        if self.queue_work(work) != constants.STATUS_SUCCESS:
+                            file_transfer.status = constants.STATUS_FULL
                     else:
                         if -90008 in reply.get("errorCodes", []):
                             sent_message.data.status = constants.STATUS_NOT_FOUND
@@ -666,18 +982,32 @@ class Handler(object):
                         file_transfer = sent_message.data
                         file_transfer.file_id = file_id
                         work = defs.Work(constants.WORK_UPLOAD, file_transfer)
-                        self.queue_work(work)
+                        if self.queue_work(work) != constants.STATUS_SUCCESS:
+                            file_transfer.status = constants.STATUS_FULL
                     else:
                         sent_message.data.status = constants.STATUS_FAILURE
 
                 elif sent_command_type == TR50Command.mailbox_check:
                     # Received a reply for a mailbox check
+                    mails = []
+                    new_mails = 0
+                    queue_full = False
                     if reply.get("success"):
-                        for mail in reply["params"]["messages"]:
+                        mails = reply["params"]["messages"]
+                        for mail in mails:
                             mail_command = mail.get("command")
                             if mail_command == "method.exec":
-                                # Action execute request in mailbox
+                                # Action execute request in mailbox. Skip
+                                # requests already in progress, and answer
+                                # those already executed from the cache.
                                 mail_id = mail.get("id")
+                                if self.mailbox_cached(mail_id):
+                                    continue
+                                with self.mailbox_lock:
+                                    if mail_id in self.mailbox_actions:
+                                        continue
+                                    self.mailbox_actions.add(mail_id)
+                                new_mails += 1
                                 action_name = mail["params"].get("method")
                                 action_params = mail["params"].get("params")
                                 action_request = defs.ActionRequest(mail_id,
@@ -685,7 +1015,14 @@ class Handler(object):
                                                                     action_params)
                                 work = defs.Work(constants.WORK_ACTION,
                                                  action_request)
-                                self.queue_work(work)
+                                if (self.queue_work(work) !=
+                                        constants.STATUS_SUCCESS):
+                                    # Left in the mailbox for a later check
+                                    with self.mailbox_lock:
+                                        self.mailbox_actions.discard(mail_id)
+                                    queue_full = True
+                    self.mailbox_checked(len(mails), reply.get("success"),
+                                         new_mails, queue_full)
 
                 elif sent_command_type == TR50Command.diag_time:
                     # Recevied a reply for a ping request
@@ -720,106 +1057,85 @@ class Handler(object):
 
         status = constants.STATUS_SUCCESS
 
-        # Collect all pending publishes in publish queue
-        to_publish = []
-        while not self.publish_queue.empty():
+        # Commands and payloads sent, when logging a summary
+        counts = None
+        if self.config.log_payload_summary:
+            counts = {}
+
+        # Collect pending publishes in rounds of at most one full telemetry
+        # batch, so urgent publishes queued in the meantime are sent in the
+        # next round instead of behind the whole backlog
+        limit = self.config.publish_max_batch or 0
+        to_publish = self.publish_queue.get_many(limit)
+        while to_publish:
             try:
-                to_publish.append(self.publish_queue.get())
-            except queue.Empty:
-                break
+                result = self.send_publishes(to_publish, counts)
+            finally:
+                self.publish_queue.task_done(len(to_publish))
+            if result != constants.STATUS_SUCCESS:
+                status = result
+            to_publish = self.publish_queue.get_many(limit)
+
+        if counts:
+            payloads = counts.pop("payloads", 0)
+            self.logger.info("MQTT queued %d payloads: %s", payloads,
+                             ", ".join("{} {}".format(count, command)
+                                       for command, count in
+                                       sorted(counts.items())))
 
-        if to_publish:
-            # If pending publishes are found, parse into list for sending
-            messages = []
-            for pub in to_publish:
-
-                # Create publish command for an alarm
-                if pub.type == "PublishAlarm":
-                    command = tr50.create_alarm_publish(self.config.key,
-                                                        pub.name, pub.state,
-                                                        message=pub.message,
-                                                        timestamp=pub.timestamp)
-                    message_desc = "Alarm Publish {}".format(pub.name)
-                    message_desc += " : {}".format(pub.state)
-                    message = defs.OutMessage(command, message_desc)
-
-                # Create publish command for strings
-                elif pub.type == "PublishAttribute":
-                    command = tr50.create_attribute_publish(self.config.key,
-                                                            pub.name, pub.value,
-                                                            timestamp=pub.timestamp)
-                    message_desc = "Attribute Publish {}".format(pub.name)
-                    message_desc += " : \"{}\"".format(pub.value)
-                    message = defs.OutMessage(command, message_desc)
-
-                # Create publish command for numbers
-                elif pub.type == "PublishTelemetry":
-                    command = tr50.create_property_publish(self.config.key,
-                                                           pub.name, pub.value,
-                                                           timestamp=pub.timestamp)
-                    message_desc = "Property Publish {}".format(pub.name)
-                    message_desc += " : {}".format(pub.value)
-                    message = defs.OutMessage(command, message_desc)
+        return status
 
-                # Create publish command for location
-                elif pub.type == "PublishLocation":
-                    command = tr50.create_location_publish(self.config.key,
-                                                           pub.latitude,
-                                                           pub.longitude,
-                                                           heading=pub.heading,
-                                                           altitude=pub.altitude,
-                                                           speed=pub.speed,
-                                                           fix_accuracy=pub.accuracy,
-                                                           fix_type=pub.fix_type,
-                                                           timestamp=pub.timestamp)
-                    message_desc = "Location Publish {}".format(str(pub))
-                    message = defs.OutMessage(command, message_desc)
+    def handle_timers(self):
+        """
+        Release summaries of aggregation windows that have ended and spooled
+        publishes, retry or expire commands whose replies are late, and grow
+        worker pools that are falling behind. Called after each MQTT loop.
+        """
 
-                # Create publish command for a log
-                elif pub.type == "PublishLog":
-                    command = tr50.create_log_publish(self.config.key,
-                                                      pub.message,
-                                                      timestamp=pub.timestamp)
-                    message_desc = "Log Publish {}".format(pub.message)
-                    message = defs.OutMessage(command, message_desc)
+        # Publish summaries of aggregation windows that have ended
+        if self.telemetry_aggregators:
+            now = time()
+            for name, aggregator in self.telemetry_aggregators.items():
+                self.queue_summaries(name, aggregator.expire(now))
+
+        # Retry or expire commands whose replies are late. No reply can
+        # arrive while disconnected, and MQTT sends unacknowledged payloads
+        # again after reconnecting, so the time spent disconnected does not
+        # count towards the deadlines.
+        now = time()
+        if now - self.last_sweep >= constants.REPLY_SWEEP_INTERVAL:
+            if self.is_connected():
+                self.sweep_replies(now)
+            else:
+                self.reply_tracker.postpone(now - self.last_sweep)
+            self.last_sweep = now
 
-                messages.append(message)
+        # Send spooled publishes again at a limited rate once connected
+        if (self.spool is not None and len(self.spool) > 0 and
+                self.is_connected()):
+            self.drain_spool()
+        else:
+            self.last_drain = time()
 
-            # Send all publishes
-            if messages:
-                status = self.send(messages)
+        # Grow worker pools whose queued work is waiting too long
+        for pool in self.work_pools.values():
+            pool.check()
 
-        return status
+        return constants.STATUS_SUCCESS
 
-    def handle_work_loop(self):
+    def handle_work(self, work):
         """
-        Loop for worker threads to handle any items put on the work queue
+        Handle an item taken from a work queue based on its type
         """
 
-        # Continuously loop while connected
-        while not self.to_quit:
-            work = None
-            try:
-                work = self.work_queue.get(timeout=self.config.loop_time)
-            except queue.Empty:
-                pass
-            # If work is retrieved from the queue, handle it based on type
-            if work:
-                try:
-                    if work.type == constants.WORK_MESSAGE:
-                        self.handle_message(work.data)
-                    elif work.type == constants.WORK_PUBLISH:
-                        self.handle_publish()
-                    elif work.type == constants.WORK_ACTION:
-                        self.handle_action(work.data)
-                    elif work.type == constants.WORK_DOWNLOAD:
-                        self.handle_file_download(work.data)
-                    elif work.type == constants.WORK_UPLOAD:
-                        self.handle_file_upload(work.data)
-                except Exception:
-                    # Print traceback, but don't kill thread
-                    self.logger.exception("Exception:")
-
+        if work.type == constants.WORK_MESSAGE:
+            self.handle_message(work.data)
+        elif work.type == constants.WORK_ACTION:
+            self.handle_action(work.data)
+        elif work.type == constants.WORK_DOWNLOAD:
+            self.handle_file_download(work.data)
+        elif work.type == constants.WORK_UPLOAD:
+            self.handle_file_upload(work.data)
         return constants.STATUS_SUCCESS
 
     def handle_ping(self):
@@ -849,6 +1165,12 @@ class Handler(object):
         """
         return self.state == constants.STATE_CONNECTED
 
+    def is_worker(self):
+        """
+        Returns True if the current thread is a worker of any pool
+        """
+
+        return any(pool.is_worker() for pool in self.work_pools.values())
 
     def log_level(self, log_level):
         """
@@ -875,10 +1197,51 @@ class Handler(object):
         #self.logger.log(logging.INFO, "This is a log with info")
         #self.logger.warning("This is a warning")
 
+    def mailbox_cached(self, mail_id):
+        """
+        Send the original ack again for a mailbox action that was already
+        executed. Returns True if it was.
+        """
+
+        if self.mailbox_cache is None:
+            return False
+        entry = self.mailbox_cache.get(mail_id)
+        if entry is None:
+            return False
+        command, description = entry
+        self.logger.info("Action %s delivered again, sending its original ack",
+                         mail_id)
+        self.send(defs.OutMessage(command, description))
+        return True
+
+    def mailbox_checked(self, count, success=True, new=None, queue_full=False):
+        """
+        Handle the end of a mailbox check that returned count messages, new of
+        them not already in progress or executed. A full page with new
+        messages means more may be waiting, so the next page is requested. If
+        the action queue was full, the next page waits for an action to
+        complete. A failed check is not repeated until the next mailbox
+        notification.
+        """
+
+        page_size = self.config.mailbox_page_size
+        if new is None:
+            new = count
+        with self.mailbox_lock:
+            self.mailbox_checking = False
+            if not success:
+                self.mailbox_pending = False
+            elif queue_full or (page_size and count >= page_size and new):
+                self.mailbox_pending = True
+            pending = self.mailbox_pending and not queue_full
+        if pending:
+            return self.check_mailbox()
+        return constants.STATUS_SUCCESS
+
     def main_loop(self):
         """
-        Main loop for MQTT to send and receive messages, as well as queue work
-        for publishing and checking timeouts
+        Main loop for MQTT to send and receive messages, as well as releasing
+        aggregated and spooled publishes and checking timeouts
         """
 
         # Continuously loop while connected or connecting
@@ -905,10 +1268,7 @@ class Handler(object):
                     break
 
             self.mqtt.loop(timeout=self.config.loop_time)
-
-            # Make a work item to publish anything that's pending
-            if not self.publish_queue.empty():
-                self.queue_work(defs.Work(constants.WORK_PUBLISH, None))
+            self.handle_timers()
 
         # One last loop to send out any pending messages
         self.mqtt.loop(timeout=0.1)
@@ -917,19 +1277,75 @@ class Handler(object):
         self.mqtt.disconnect()
 
         # Wait for worker threads to finish.
-        for thread in self.worker_threads:
-            thread.join()
-        self.worker_threads = []
-
-        # On disconnect, show all messages that never received replies
-        if len(self.reply_tracker) > 0:
-            self.logger.error("These messages never received a reply:")
-            for mid, message in self.reply_tracker.items():
-                self.logger.error(".... %s - %s", mid,
-                                  message.description)
+        for pool in self.work_pools.values():
+            pool.stop()
+        for pool in self.work_pools.values():
+            pool.join()
+        if self.publish_thread:
+            self.publish_thread.join()
+            self.publish_thread = None
+
+        self.abandon_replies()
+        if self.spool is not None:
+            self.spool.close()
 
         return constants.STATUS_SUCCESS
 
+    def mqtt_connect(self):
+        """
+        Start the MQTT connection to the Cloud. It is complete once on_connect
+        is called with its result.
+        """
+
+        self.to_quit = False
+        status = constants.STATUS_FAILURE
+        result = -1
+
+        # Ensure we have a host and port to connect to
+        if not self.config.cloud.host or not self.config.cloud.port:
+            self.logger.error("Missing host or port from configuration")
+            status = constants.STATUS_BAD_PARAMETER
+
+        else:
+            self.state = constants.STATE_CONNECTING
+
+            # Start a secure connection if using a secure port and the cert file
+            # is available
+            if self.config.cloud.port in constants.SECURE_PORTS:
+                if self.config.validate_cloud_cert is False:
+                    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+                    context.verify_mode = ssl.CERT_NONE
+                    context.check_hostname = False
+                    self.mqtt.tls_set_context(context)
+                elif not self.config.ca_bundle_file:
+                    self.logger.error("Missing certificate bundle from configuration")
+                    status = constants.STATUS_BAD_PARAMETER
+                elif not os.path.isfile(self.config.ca_bundle_file):
+                    self.logger.error("Certificate bundle not found")
+                    status = constants.STATUS_NOT_FOUND
+                else:
+                    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+                    context.load_verify_locations(cafile=self.config.ca_bundle_file)
+                    context.verify_mode = ssl.CERT_REQUIRED
+                    context.check_hostname = True
+                    self.mqtt.tls_set_context(context)
+
+
+            # status != bad_parameter or not_found
+            if status == constants.STATUS_FAILURE:
+                # Start MQTT connection
+                try:
+                    result = self.mqtt.connect(self.config.cloud.host,
+                                               self.config.cloud.port, 60)
+                except Exception as error:
+                    # socket.gaierror or ssl.SSLError
+                    self.state = constants.STATE_DISCONNECTED
+                    self.logger.error(str(error))
+
+        if result == 0:
+            status = constants.STATUS_SUCCESS
+        return status
+
     def on_connect(self, mqtt, userdata, flags, rc):
         """
         Callback when MQTT Client connects to Cloud
@@ -939,6 +1355,7 @@ class Handler(object):
         self.logger.info("MQTT connected: %s", mqttlib.connack_string(rc))
         if rc == 0:
             self.state = constants.STATE_CONNECTED
+            self.resubmit()
         else:
             self.state = constants.STATE_DISCONNECTED
             self.last_connected = datetime.utcnow()
@@ -960,9 +1377,9 @@ class Handler(object):
         Callback when MQTT Client receives a message
         """
 
-        message = defs.Message(msg.topic, json.loads(msg.payload.decode()))
-        self.logger.debug("Received message on topic \"%s\"\n%s", msg.topic,
-                          message)
+        # Only the raw payload is passed on. Decoding and logging it are left
+        # to the worker, so they don't block the main loop.
+        message = defs.Message(msg.topic, payload=msg.payload)
 
         # Queue work to handle received message. Don't block main loop with this
         # task.
@@ -974,33 +1391,176 @@ class Handler(object):
         Notify that a message has been published
         """
 
-        topic_num = self.reply_tracker.pop_mid(mid)
-        self.logger.debug("MQTT sent %s", topic_num)
+        topic_id = self.reply_tracker.pop_mid(mid)
+        if topic_id is not None:
+            self.logger.debug("MQTT sent %s", self.reply_tracker.topic(topic_id))
+
+    def publish_loop(self):
+        """
+        Loop for the publish thread. Pending publishes are sent once
+        publish_linger seconds have passed since the first one was queued,
+        publish_linger_count are pending, or an urgent publish is queued.
+        """
+
+        while not self.to_quit:
+            pending = self.publish_queue.wait(self.config.publish_linger_count,
+                                              self.config.publish_linger,
+                                              self.config.loop_time)
+            if pending:
+                try:
+                    self.handle_publish()
+                except Exception:
+                    # Print traceback, but don't kill thread
+                    self.logger.exception("Exception:")
+
+        return constants.STATUS_SUCCESS
+
+    def queue_future(self, pub):
+        """
+        Place pub in the publish queue, returning a future that is resolved
+        with the status of the reply to its command
+        """
+
+        pub.future = futures.Future()
+        pub_class = pub.__class__
+        if (pub_class is defs.PublishTelemetry or
+                pub_class is defs.PublishTelemetryBlock):
+            self.queue_telemetry(pub)
+        else:
+            self.queue_publish(pub)
+        return pub.future
+
+    def queue_points(self, name, points):
+        """
+        Place (timestamp, value) points of one telemetry key in the publish
+        queue
+        """
+
+        if len(points) == 1:
+            pub = defs.PublishTelemetry(name, points[0][1])
+            pub.timestamp = points[0][0]
+        elif points:
+            timestamps, values = zip(*points)
+            pub = defs.PublishTelemetryBlock(name, values, timestamps)
+        else:
+            return constants.STATUS_SUCCESS
+        return self.queue_publish(pub)
 
     def queue_publish(self, pub):
         """
-        Place pub in the publish queue
+        Place pub in the publish queue. Returns STATUS_FULL if the queue is full
+        and its policy rejects pub.
         """
 
-        self.publish_queue.put(pub)
+        # Never block the main loop, it is what empties the queue
+        block = threading.current_thread() is not self.main_thread
+        evicted = []
+        queued = self.publish_queue.put(pub, pub.priority, block=block,
+                                        evicted=evicted)
+
+        # Publishes discarded to make room will never be sent
+        for old_pub in evicted:
+            defs.set_result(old_pub.future, constants.STATUS_FULL)
+        if not queued:
+            self.logger.debug("Publish queue full, publish rejected")
+            defs.set_result(pub.future, constants.STATUS_FULL)
+            return constants.STATUS_FULL
+
+        # Urgent publishes don't wait for the rest of the linger
+        if pub.priority <= constants.PRIORITY_IMMEDIATE:
+            self.publish_queue.flush()
+        if self.publish_notify is not None:
+            self.publish_notify(pub)
         return constants.STATUS_SUCCESS
 
+    def queue_summaries(self, name, summaries):
+        """
+        Place the min, max, mean and count of closed aggregation windows of one
+        telemetry key in the publish queue
+        """
+
+        status = constants.STATUS_SUCCESS
+        for summary in summaries:
+            timestamp = summary[0]
+            for suffix, value in zip((".min", ".max", ".mean", ".count"),
+                                     summary[1:]):
+                pub = defs.PublishTelemetry(name + suffix, value)
+                pub.timestamp = timestamp
+                result = self.queue_telemetry(pub)
+                if result != constants.STATUS_SUCCESS:
+                    status = result
+        return status
+
+    def queue_telemetry(self, pub):
+        """
+        Place telemetry in the publish queue, after any aggregation or
+        compression configured for its key. Aggregated keys only publish the
+        summaries of their windows. The future of pub, if any, is resolved once
+        its values are taken in by aggregation or compression.
+        """
+
+        aggregator = self.telemetry_aggregators.get(pub.name)
+        if aggregator is not None:
+            if pub.__class__ is defs.PublishTelemetry:
+                summaries = aggregator.add(pub.timestamp, pub.value)
+            else:
+                summaries = aggregator.add_many(zip(pub.times(), pub.values))
+            status = self.queue_summaries(pub.name, summaries)
+            defs.set_result(pub.future, status)
+            return status
+
+        telemetry_filter = self.telemetry_filters.get(pub.name)
+        if telemetry_filter is None:
+            return self.queue_publish(pub)
+
+        if pub.__class__ is defs.PublishTelemetry:
+            points = telemetry_filter.filter(pub.timestamp, pub.value)
+            if len(points) == 1 and points[0][0] == pub.timestamp:
+                return self.queue_publish(pub)
+        else:
+            points = telemetry_filter.filter_many(zip(pub.times(), pub.values))
+        status = self.queue_points(pub.name, points)
+        defs.set_result(pub.future, status)
+        return status
+
     def queue_work(self, work):
         """
-        Place work in the work queue
+        Place work in the queue of the pool that handles its type. Returns
+        STATUS_FULL if that queue is full.
         """
 
-        self.work_queue.put(work)
+        pool = self.work_pools[constants.WORK_POOLS[work.type]]
+        if not pool.put(work):
+            self.logger.error("Work queue of %s pool full", pool.name)
+            return constants.STATUS_FULL
         return constants.STATUS_SUCCESS
 
+    def reply_timeout(self, command):
+        """
+        Returns the seconds to wait for the reply to a TR50 command, from
+        reply_timeouts or reply_timeout
+        """
+
+        timeouts = self.config.reply_timeouts or {}
+        return timeouts.get(command, self.config.reply_timeout)
+
     def request_download(self, file_name, file_dest, blocking=False,
                          callback=None, timeout=0, file_global=False):
         """
         Request a C2D file transfer
         """
 
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=timeout)
+        future = self.request_download_async(file_name, file_dest,
+                                             callback=callback,
+                                             file_global=file_global)
+        return self.transfer_status(future, blocking, timeout)
+
+    def request_download_async(self, file_name, file_dest, callback=None,
+                               file_global=False):
+        """
+        Request a C2D file transfer, returning a future that is resolved with
+        the status of the transfer
+        """
 
         self.logger.info("Request download of %s", file_name)
 
@@ -1017,20 +1577,10 @@ class Handler(object):
         message = defs.OutMessage(command, "Download {}".format(file_name),
                                   data=transfer)
         status = self.send(message)
+        if status != constants.STATUS_SUCCESS:
+            defs.set_result(transfer.future, status)
 
-        # If blocking is set, wait for result of file transfer
-        if status == constants.STATUS_SUCCESS and blocking:
-            while ((timeout == 0 or current_time < end_time) and
-                   transfer.status is None):
-                sleep(0.1)
-                current_time = datetime.utcnow()
-
-            if transfer.status is None:
-                status = constants.STATUS_TIMED_OUT
-            else:
-                status = transfer.status
-
-        return status
+        return transfer.future
 
     def request_upload(self, file_path, upload_name=None, blocking=False,
                        callback=None, timeout=0, file_global=False):
@@ -1038,70 +1588,118 @@ class Handler(object):
         Request a D2C file transfer
         """
 
-        status = constants.STATUS_SUCCESS
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=timeout)
-        transfer = None
+        future = self.request_upload_async(file_path, upload_name,
+                                           callback=callback,
+                                           file_global=file_global)
+        return self.transfer_status(future, blocking, timeout)
+
+    def request_upload_async(self, file_path, upload_name=None, callback=None,
+                             file_global=False):
+        """
+        Request a D2C file transfer, returning a future that is resolved with
+        the status of the transfer
+        """
 
         self.logger.info("Request upload of %s", file_path)
 
+        future = futures.Future()
+
         # Path must be absolute
         if not os.path.isabs(file_path):
             self.logger.error("Path must be absolute \"%s\"", file_path)
-            status = constants.STATUS_NOT_FOUND
+            defs.set_result(future, constants.STATUS_NOT_FOUND)
 
-        if status == constants.STATUS_SUCCESS:
-            # Check if file exists
-            if not os.path.isfile(file_path):
-                # No file to upload
-                self.logger.error("Cannot find file %s. "
-                                  "Upload cancelled.", file_path)
-                status = constants.STATUS_NOT_FOUND
-            else:
-                transfer = None
-                file_name = os.path.basename(file_path)
-                if not upload_name:
-                    upload_name = file_name
+        # Check if file exists
+        elif not os.path.isfile(file_path):
+            # No file to upload
+            self.logger.error("Cannot find file %s. "
+                              "Upload cancelled.", file_path)
+            defs.set_result(future, constants.STATUS_NOT_FOUND)
 
-                # Get file crc32 checksum
-                checksum = 0
-                with open(file_path, "rb") as up_file:
-                    for chunk in up_file:
-                        checksum = crc32(chunk, checksum)
-                checksum = checksum & 0xffffffff
-
-                # File Transfer object for tracking progress
-                transfer = defs.FileTransfer(upload_name, file_path,
-                                             self.client,
-                                             callback=callback)
-
-                # Generate and send message to request file transfer
-                command = tr50.create_file_put(self.config.key, upload_name,
-                                               crc32=checksum,
-                                               file_global=file_global)
-                message_desc = "Upload {} as {}".format(file_name,
-                                                        upload_name)
-                message = defs.OutMessage(command, message_desc,
-                                          data=transfer)
-                status = self.send(message)
-
-                # If blocking is set, wait for result of file transfer
-                if status == constants.STATUS_SUCCESS and blocking:
-                    while ((timeout == 0 or current_time < end_time) and
-                           not self.to_quit and transfer.status is None):
-                        sleep(0.1)
-                        current_time = datetime.utcnow()
-
-                    if transfer.status is None:
-                        status = constants.STATUS_TIMED_OUT
-                    else:
-                        status = transfer.status
+        else:
+            file_name = os.path.basename(file_path)
+            if not upload_name:
+                upload_name = file_name
+
+            # Get file crc32 checksum
+            checksum = 0
+            with open(file_path, "rb") as up_file:
+                for chunk in up_file:
+                    checksum = crc32(chunk, checksum)
+            checksum = checksum & 0xffffffff
+
+            # File Transfer object for tracking progress
+            transfer = defs.FileTransfer(upload_name, file_path, self.client,
+                                         callback=callback)
+            future = transfer.future
+
+            # Generate and send message to request file transfer
+            command = tr50.create_file_put(self.config.key, upload_name,
+                                           crc32=checksum,
+                                           file_global=file_global)
+            message_desc = "Upload {} as {}".format(file_name, upload_name)
+            message = defs.OutMessage(command, message_desc, data=transfer)
+            status = self.send(message)
+            if status != constants.STATUS_SUCCESS:
+                defs.set_result(future, status)
+
+        return future
+
+    def resubmit(self):
+        """
+        Send again the commands still waiting for replies whose payloads the
+        MQTT broker acknowledged. Their replies are lost with the connection,
+        while MQTT retransmits payloads that were not acknowledged by itself.
+        Commands that cannot safely be repeated expire instead, as they do
+        when their replies time out.
+        """
 
+        status = constants.STATUS_SUCCESS
+        messages = []
+        for message in self.reply_tracker.pop_acked():
+            if message.command.get("command") in RETRY_COMMANDS:
+                messages.append(message)
+            else:
+                self.logger.error("Reply to %s lost on reconnect, giving up",
+                                  message)
+                self.expire_reply(message)
+        if not messages:
+            return status
+
+        self.logger.info("Resubmitting %d commands waiting for replies",
+                         len(messages))
+        commands = [message.command for message in messages]
+        payloads = tr50.generate_requests(commands,
+                                          self.config.publish_max_commands,
+                                          self.config.publish_max_bytes)
+        start = 0
+        for count, payload in payloads:
+            result = self.send(messages[start:start + count], payload=payload,
+                               timeout=0)
+            if result != constants.STATUS_SUCCESS:
+                status = result
+            start += count
         return status
 
-    def send(self, messages):
+    def sample_payload(self):
+        """
+        Returns True if the payload being sent should be logged, which is one
+        in every log_payload_sample payloads unless a summary is logged instead
+        """
+
+        sample = self.config.log_payload_sample
+        if (not sample or self.config.log_payload_summary or
+                not self.logger.isEnabledFor(logging.INFO)):
+            return False
+        return next(self.payload_counter) % sample == 0
+
+    def send(self, messages, payload=None, track=True, timeout=None):
         """
-        Send commands to the Cloud, and track them to wait for replies
+        Send commands to the Cloud, and track them to wait for replies. payload
+        may hold the request string already generated for these messages.
+        Untracked commands are sent at QoS 0 on the no reply topic. timeout
+        overrides in_flight_timeout. The future of each message is resolved
+        with the status of its reply, or of sending it if it is not tracked.
         """
         status = constants.STATUS_FAILURE
 
@@ -1110,43 +1708,327 @@ class Handler(object):
             message_list = [messages]
 
         # Generate final request string
-        payload = tr50.generate_request([x.command for x in message_list])
+        if payload is None:
+            payload = tr50.generate_request([x.command for x in message_list])
+
+        if not track:
+            result, mid = self.mqtt.publish(
+                "api/{}".format(constants.NO_REPLY_TOPIC), payload, 0)
+            self.logger.debug("MQTT queued %d commands without replies",
+                              len(message_list))
+            if result == mqttlib.MQTT_ERR_SUCCESS:
+                self.reply_tracker.add_mid(mid, 0)
+                status = constants.STATUS_SUCCESS
+            for msg in message_list:
+                defs.set_result(msg.future, status)
+            return status
 
-        # Lock to ensure all outgoing messages are tracked before handling
-        # received messages
-        self.lock.acquire()
+        # Mark when messages were sent, and when their replies are due
+        current_time = datetime.utcnow()
+        now = time()
+        for msg in message_list:
+            msg.timestamp = current_time
+            reply_timeout = self.reply_timeout(msg.command.get("command"))
+            if reply_timeout:
+                msg.deadline = now + reply_timeout * 2 ** msg.retries
+
+        # Track the messages on a free topic before publishing, so a reply can
+        # never arrive before its message. Wait for a free topic if the
+        # maximum number of payloads are waiting for replies.
+        if timeout is None:
+            timeout = self.config.in_flight_timeout
+            # Never block the main loop, it is what receives the replies
+            if threading.current_thread() is self.main_thread:
+                timeout = 0
+        topic_id = self.reply_tracker.add_messages(message_list, timeout)
+        if topic_id is None:
+            self.logger.error("%d payloads waiting for replies, dropped %d "
+                              "commands", self.reply_tracker.max_topics,
+                              len(message_list))
+            for msg in message_list:
+                defs.set_result(msg.future, constants.STATUS_FULL)
+            return constants.STATUS_FULL
+        topic_num = self.reply_tracker.topic(topic_id)
+
+        # Send payload over MQTT
         try:
-            # Obtain new unused topic number
-            while True:
-                topic_num = "{:0>4}".format(self.topic_counter)
-                self.topic_counter += 1
-                if topic_num not in self.reply_tracker:
-                    break
+            result, mid = self.mqtt.publish("api/" + topic_num, payload, 1)
+        except Exception:
+            # Nothing was sent, so no replies will come
+            self.reply_tracker.remove_topic(topic_id)
+            for msg in message_list:
+                defs.set_result(msg.future, constants.STATUS_FAILURE)
+            raise
+
+        # Track the topic this message will send on
+        self.reply_tracker.add_mid(mid, topic_id)
+        status = constants.STATUS_SUCCESS
 
-            # Send payload over MQTT
-            result, mid = self.mqtt.publish("api/{}".format(topic_num),
-                                            payload, 1)
+        # Log the commands outside of the lock. Commands are only formatted if
+        # the record is emitted.
+        if self.sample_payload():
+            for msg in message_list:
+                self.logger.info("MQTT queued %s-%d - %s\n%s", topic_num,
+                                 msg.out_id[1], msg, defs.LazyJson(msg.command))
 
-            # Track the topic this message will send on
-            self.reply_tracker.add_mid(mid, topic_num)
+        return status
 
-            # Current timestamp to mark when message was sent
-            current_time = datetime.utcnow()
+    def send_publishes(self, to_publish, counts=None):
+        """
+        Send a list of publishes taken from the publish queue. If counts is a
+        dict, the number of payloads and of each command sent are added to it.
+        """
 
-            # Track each message
-            for num, msg in enumerate(message_list):
-                # Add timestamps and ids
-                msg.timestamp = current_time
-                msg.out_id = "{}-{}".format(topic_num, num+1)
+        status = constants.STATUS_SUCCESS
 
-                self.reply_tracker.add_message(msg)
-                self.logger.info("MQTT queued %s-%d - %s\n%s", topic_num, num+1,
-                                 msg, json.dumps(msg.command, indent=2,
-                                                 sort_keys=True))
-            status = constants.STATUS_SUCCESS
+        if to_publish and (self.config.publish_coalesce or self.on_change):
+            kept = self.coalesce_publishes(to_publish)
+            if len(kept) < len(to_publish):
+                # Dropped publishes are already reflected in the Cloud
+                kept_set = set(kept)
+                for pub in to_publish:
+                    if pub.future is not None and pub not in kept_set:
+                        defs.set_result(pub.future, constants.STATUS_SUCCESS)
+            to_publish = kept
+
+        # Keep publishes on disk until the connection is back
+        if to_publish and self.spool is not None and not self.is_connected():
+            evicted = self.spool.put(to_publish)
+            if evicted:
+                self.logger.warning("Publish spool full, dropped %d oldest "
+                                    "publishes", evicted)
+            for pub in to_publish:
+                defs.set_result(pub.future, constants.STATUS_TRY_AGAIN)
+            return status
+
+        if to_publish:
+            # If pending publishes are found, parse into list for sending.
+            # Telemetry is grouped by key, taking the position of the first
+            # sample of each key.
+            messages = []
+            telemetry = {}
+            for pub in to_publish:
+
+                # Collect telemetry samples for their key
+                pub_class = pub.__class__
+                if (pub_class is defs.PublishTelemetry or
+                        pub_class is defs.PublishTelemetryBlock):
+                    samples = telemetry.get(pub.name)
+                    if samples is None:
+                        samples = telemetry[pub.name] = []
+                        messages.append(samples)
+                    samples.append(pub)
+                    continue
+
+                timestamp = tr50.format_timestamp(pub.timestamp)
+
+                # Create publish command for an alarm
+                if pub_class is defs.PublishAlarm:
+                    command = tr50.create_alarm_publish(self.config.key,
+                                                        pub.name, pub.state,
+                                                        message=pub.message,
+                                                        timestamp=timestamp)
+                    message_desc = "Alarm Publish {}".format(pub.name)
+                    message_desc += " : {}".format(pub.state)
+                    message = defs.OutMessage(command, message_desc)
+
+                # Create publish command for strings
+                elif pub_class is defs.PublishAttribute:
+                    command = tr50.create_attribute_publish(self.config.key,
+                                                            pub.name, pub.value,
+                                                            timestamp=timestamp)
+                    message_desc = "Attribute Publish {}".format(pub.name)
+                    message_desc += " : \"{}\"".format(pub.value)
+                    message = defs.OutMessage(command, message_desc)
+
+                # Create publish command for location
+                elif pub_class is defs.PublishLocation:
+                    command = tr50.create_location_publish(self.config.key,
+                                                           pub.latitude,
+                                                           pub.longitude,
+                                                           heading=pub.heading,
+                                                           altitude=pub.altitude,
+                                                           speed=pub.speed,
+                                                           fix_accuracy=pub.accuracy,
+                                                           fix_type=pub.fix_type,
+                                                           timestamp=timestamp)
+                    message_desc = "Location Publish {}".format(str(pub))
+                    message = defs.OutMessage(command, message_desc)
 
-        finally:
-            self.lock.release()
+                # Create publish command for a log
+                elif pub_class is defs.PublishLog:
+                    command = tr50.create_log_publish(self.config.key,
+                                                      pub.message,
+                                                      timestamp=timestamp)
+                    message_desc = "Log Publish {}".format(pub.message)
+                    message = defs.OutMessage(command, message_desc)
+
+                if pub.future is not None:
+                    defs.chain_futures([message.future], pub.future)
+                messages.append(message)
+
+            # Create publish commands for numbers
+            pending = messages
+            messages = []
+            for message in pending:
+                if message.__class__ is list:
+                    batch = self.telemetry_messages(message)
+                    waiting = [pub.future for pub in message
+                               if pub.future is not None]
+                    if waiting:
+                        # Every sample of a key waits on all of its batches
+                        group = batch[0].future
+                        if len(batch) > 1:
+                            group = futures.Future()
+                            defs.chain_futures([msg.future for msg in batch],
+                                               group)
+                        for future in waiting:
+                            defs.chain_futures([group], future)
+                    messages.extend(batch)
+                else:
+                    messages.append(message)
+
+            # Separate publishes that don't need their replies tracked
+            untracked = []
+            if self.no_reply:
+                pending = messages
+                messages = []
+                for message in pending:
+                    if message.command["command"] in self.no_reply:
+                        untracked.append(message)
+                    else:
+                        messages.append(message)
+
+            # Send all publishes, split into bounded payloads. Payloads are
+            # sent back to back without waiting for replies.
+            for group, track in ((messages, True), (untracked, False)):
+                commands = [message.command for message in group]
+                payloads = tr50.generate_requests(
+                    commands, self.config.publish_max_commands,
+                    self.config.publish_max_bytes)
+                start = 0
+                for count, payload in payloads:
+                    result = self.send(group[start:start + count],
+                                       payload=payload, track=track)
+                    if result != constants.STATUS_SUCCESS:
+                        status = result
+                    start += count
+
+                if counts is not None and payloads:
+                    counts["payloads"] = (counts.get("payloads", 0) +
+                                          len(payloads))
+                    for command in commands:
+                        name = command["command"]
+                        counts[name] = counts.get(name, 0) + 1
 
         return status
 
+    @property
+    def state(self):
+        """
+        Connection state of the Client. Setting it notifies state_changed.
+        """
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        with self.state_changed:
+            self._state = value
+            self.state_changed.notify_all()
+
+    def sweep_replies(self, now):
+        """
+        Handle messages whose replies have not arrived by their deadline.
+        Commands that can safely be repeated are sent again with double the
+        timeout, up to reply_retries times. Others expire, failing any file
+        transfer waiting on them.
+        """
+
+        for message in self.reply_tracker.pop_expired(now):
+            command = message.command.get("command")
+            if (command in RETRY_COMMANDS and
+                    message.retries < self.config.reply_retries):
+                message.retries += 1
+                self.logger.warning("No reply for %s, sending again (retry "
+                                    "%d)", message, message.retries)
+                if self.send(message, timeout=0) == constants.STATUS_SUCCESS:
+                    self.replies_retried += 1
+                    continue
+
+            self.logger.error("No reply for %s, giving up", message)
+            self.expire_reply(message)
+
+        return constants.STATUS_SUCCESS
+
+    def telemetry_messages(self, samples):
+        """
+        Create the messages publishing all pending samples of one telemetry key
+        """
+
+        name = samples[0].name
+        if len(samples) == 1 and samples[0].__class__ is defs.PublishTelemetry:
+            pub = samples[0]
+            timestamp = tr50.format_timestamp(pub.timestamp)
+            command = tr50.create_property_publish(self.config.key, name,
+                                                   pub.value,
+                                                   timestamp=timestamp)
+            message_desc = "Property Publish {}".format(name)
+            message_desc += " : {}".format(pub.value)
+            return [defs.OutMessage(command, message_desc)]
+
+        def pairs():
+            # Value/timestamp pairs of single samples and blocks, with the
+            # timestamps formatted as each batch is built
+            for pub in samples:
+                if pub.__class__ is defs.PublishTelemetry:
+                    yield pub.value, tr50.format_timestamp(pub.timestamp)
+                else:
+                    for value, timestamp in zip(pub.values, pub.times()):
+                        yield value, tr50.format_timestamp(timestamp)
+
+        # Keep each batch command within the configured number of values
+        count = sum(len(pub.values) if pub.__class__ is
+                    defs.PublishTelemetryBlock else 1 for pub in samples)
+        max_batch = self.config.publish_max_batch or count
+        data = pairs()
+        messages = []
+        for _ in range(0, count, max_batch):
+            batch = list(itertools.islice(data, max_batch))
+            command = tr50.create_property_batch(self.config.key, name, batch)
+            message_desc = "Property Batch {}".format(name)
+            message_desc += " : {} values".format(len(batch))
+            messages.append(defs.OutMessage(command, message_desc))
+        return messages
+
+    def transfer_status(self, future, blocking=False, timeout=0):
+        """
+        Returns the status of a file transfer future. Without blocking, this is
+        the status of its request unless the transfer has already finished.
+        """
+
+        if not blocking:
+            if future.done():
+                return future.result()
+            return constants.STATUS_SUCCESS
+
+        try:
+            return future.result(timeout or None)
+        except futures.TimeoutError:
+            return constants.STATUS_TIMED_OUT
+
+    def wait_state(self, state, timeout=0):
+        """
+        Wait up to timeout seconds (0 for no limit) while the connection state
+        is state. Returns the connection state.
+        """
+
+        end_time = time() + timeout
+        with self.state_changed:
+            while self._state == state and not self.to_quit:
+                remaining = None
+                if timeout:
+                    remaining = end_time - time()
+                    if remaining <= 0:
+                        break
+                self.state_changed.wait(remaining)
+            return self._state
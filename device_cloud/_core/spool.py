@@ -0,0 +1,214 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the disk-backed spool that holds publishes while the
+Client is not connected to the Cloud
+"""
+
+import json
+import sqlite3
+import threading
+from time import time
+
+from device_cloud._core import defs
+
+
+def _slots(pub_class):
+    """
+    Return all slot names of a publish class that are stored, base class
+    first. Futures only live as long as the process and are not stored.
+    """
+
+    slots = []
+    for cls in reversed(pub_class.__mro__):
+        slots.extend(slot for slot in getattr(cls, "__slots__", ())
+                     if slot != "future")
+    return slots
+
+# Publish classes that can be spooled, by name
+SPOOL_CLASSES = dict((cls.__name__, (cls, _slots(cls))) for cls in [
+    defs.PublishAlarm,
+    defs.PublishAttribute,
+    defs.PublishLocation,
+    defs.PublishLog,
+    defs.PublishTelemetry,
+    defs.PublishTelemetryBlock
+])
+
+
+def dump_publish(pub):
+    """
+    Serialise a publish record to a JSON string
+    """
+
+    slots = SPOOL_CLASSES[pub.__class__.__name__][1]
+    record = [pub.__class__.__name__]
+    record.extend([getattr(pub, slot) for slot in slots])
+    return json.dumps(record, separators=(",", ":"))
+
+def load_publish(string):
+    """
+    Restore a publish record from a JSON string
+    """
+
+    record = json.loads(string)
+    pub_class, slots = SPOOL_CLASSES[record[0]]
+    pub = pub_class.__new__(pub_class)
+    pub.future = None
+    for slot, value in zip(slots, record[1:]):
+        setattr(pub, slot, value)
+    return pub
+
+
+class PublishSpool(object):
+    """
+    SQLite database (in WAL mode) of publishes waiting for a connection. Size
+    and age quotas are enforced by evicting the oldest publishes first. The
+    database is opened on creation, and can be closed and opened again.
+    """
+
+    def __init__(self, path, max_size=0, max_age=0):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.database = None
+        self.count = 0
+        self.size = 0
+        self.open()
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        """
+        Close the database, if it is open
+        """
+
+        with self.lock:
+            if self.database is not None:
+                self.database.close()
+                self.database = None
+
+    def open(self):
+        """
+        Open the database, if it is closed
+        """
+
+        with self.lock:
+            if self.database is not None:
+                return
+            self.database = sqlite3.connect(self.path,
+                                            check_same_thread=False)
+            self.database.execute("PRAGMA journal_mode=WAL")
+            self.database.execute("PRAGMA synchronous=NORMAL")
+            self.database.execute("CREATE TABLE IF NOT EXISTS publishes ("
+                                  "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                  "ts REAL NOT NULL, "
+                                  "record TEXT NOT NULL)")
+            self.database.execute("CREATE INDEX IF NOT EXISTS publishes_ts "
+                                  "ON publishes (ts, id)")
+            self.database.commit()
+
+            # Running totals so quotas can be checked without scanning the
+            # table
+            self.count, self.size = self._totals()
+
+    def get(self, limit):
+        """
+        Retrieve up to limit of the oldest publishes as (id, publish) tuples
+        """
+
+        with self.lock:
+            self._evict_expired()
+            rows = self.database.execute("SELECT id, record FROM publishes "
+                                         "ORDER BY ts, id LIMIT ?",
+                                         (limit,)).fetchall()
+        return [(row[0], load_publish(row[1])) for row in rows]
+
+    def put(self, pubs):
+        """
+        Store publishes. Returns the number of publishes evicted to stay within
+        the quotas.
+        """
+
+        rows = [(pub.timestamp, dump_publish(pub)) for pub in pubs]
+        with self.lock:
+            self.database.executemany("INSERT INTO publishes (ts, record) "
+                                      "VALUES (?, ?)", rows)
+            self.database.commit()
+            self.count += len(rows)
+            self.size += sum(len(row[1]) for row in rows)
+            return self._evict_expired() + self._evict_oversize()
+
+    def remove(self, ids):
+        """
+        Remove publishes that have been retrieved and handed back for sending
+        """
+
+        ids = list(ids)
+        with self.lock:
+            # Stay well below the SQLite limit of variables per statement
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                where = "WHERE id IN ({})".format(",".join("?" * len(chunk)))
+                count, size = self.database.execute(
+                    "SELECT COUNT(*), SUM(length(record)) FROM publishes " +
+                    where, chunk).fetchone()
+                self.database.execute("DELETE FROM publishes " + where, chunk)
+                self.count -= count
+                self.size -= size or 0
+            self.database.commit()
+
+    def _evict_expired(self):
+        if not self.max_age or not self.count:
+            return 0
+        cutoff = time() - self.max_age
+        oldest = self.database.execute("SELECT MIN(ts) FROM "
+                                       "publishes").fetchone()[0]
+        if oldest is None or oldest >= cutoff:
+            return 0
+        self.database.execute("DELETE FROM publishes WHERE ts < ?", (cutoff,))
+        self.database.commit()
+        count = self.count
+        self.count, self.size = self._totals()
+        return count - self.count
+
+    def _evict_oversize(self):
+        evicted = 0
+        while self.max_size and self.size > self.max_size and self.count:
+            # Drop the oldest publishes until the spool fits again
+            excess = self.size - self.max_size
+            rows = self.database.execute("SELECT id, length(record) FROM "
+                                         "publishes ORDER BY ts, id "
+                                         "LIMIT 100").fetchall()
+            ids = []
+            for row_id, length in rows:
+                if excess <= 0:
+                    break
+                ids.append((row_id,))
+                excess -= length
+                self.size -= length
+            self.database.executemany("DELETE FROM publishes WHERE id = ?",
+                                      ids)
+            self.database.commit()
+            self.count -= len(ids)
+            evicted += len(ids)
+        return evicted
+
+    def _totals(self):
+        count, size = self.database.execute("SELECT COUNT(*), "
+                                            "SUM(length(record)) FROM "
+                                            "publishes").fetchone()
+        return count, size or 0
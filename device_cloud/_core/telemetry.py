@@ -0,0 +1,280 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the per-key processing applied to telemetry before it is
+placed in the publish queue
+"""
+
+import threading
+
+
+def create_aggregator(settings):
+    """
+    Create a window aggregator from its configuration, either the window length
+    in seconds or a dict holding it as window
+    """
+
+    window = settings
+    if isinstance(settings, dict):
+        window = settings.get("window")
+    if window is None:
+        raise ValueError("Missing aggregation window {}".format(settings))
+    return WindowAggregator(window)
+
+def create_filter(settings):
+    """
+    Create a telemetry filter from its configuration. Supported settings are
+    deadband, deadband_percent or swinging_door, each with an optional
+    max_interval in seconds after which a value is always published.
+    """
+
+    max_interval = settings.get("max_interval", 0)
+    if settings.get("swinging_door") is not None:
+        return SwingingDoorFilter(settings["swinging_door"], max_interval)
+    elif settings.get("deadband_percent") is not None:
+        return DeadbandFilter(settings["deadband_percent"], True, max_interval)
+    elif settings.get("deadband") is not None:
+        return DeadbandFilter(settings["deadband"], False, max_interval)
+    raise ValueError("Unknown telemetry compression {}".format(settings))
+
+
+class TelemetryFilter(object):
+    """
+    Super Class for telemetry compression of a single key. Filters take
+    (timestamp, value) points and return the points that should be published.
+    Each subclass defines _filter(timestamp, value), which filter and
+    filter_many call with the lock held for every point, and which returns a
+    list of the points to publish.
+    """
+
+    def __init__(self, max_interval=0):
+        self.max_interval = max_interval
+        self.lock = threading.Lock()
+
+    def filter(self, timestamp, value):
+        """
+        Filter a single point
+        """
+
+        with self.lock:
+            return self._filter(timestamp, value)
+
+    def filter_many(self, points):
+        """
+        Filter a sequence of points in order
+        """
+
+        result = []
+        with self.lock:
+            for timestamp, value in points:
+                result.extend(self._filter(timestamp, value))
+        return result
+
+    def flush(self):
+        """
+        Return any point held back by the filter
+        """
+
+        return []
+
+
+class DeadbandFilter(TelemetryFilter):
+    """
+    Publishes a value only when it moves outside a band around the last
+    published value. The band is absolute, or a percentage of the last
+    published value.
+    """
+
+    def __init__(self, deadband, percent=False, max_interval=0):
+        super(DeadbandFilter, self).__init__(max_interval)
+        self.deadband = deadband
+        self.percent = percent
+        self.last = None
+
+    def _filter(self, timestamp, value):
+        if self.last is not None:
+            last_timestamp, last_value = self.last
+            band = self.deadband
+            if self.percent:
+                band = abs(last_value) * self.deadband / 100.0
+            if (abs(value - last_value) <= band and
+                    (not self.max_interval or
+                     timestamp - last_timestamp < self.max_interval)):
+                return []
+        self.last = (timestamp, value)
+        return [self.last]
+
+
+class SwingingDoorFilter(TelemetryFilter):
+    """
+    Swinging door trending. Values are held back for as long as a straight line
+    from the last published point stays within the deviation of every value
+    received since. When a value opens the door past that, the value before it
+    is published and becomes the new pivot.
+    """
+
+    def __init__(self, deviation, max_interval=0):
+        super(SwingingDoorFilter, self).__init__(max_interval)
+        self.deviation = deviation
+        self.pivot = None
+        self.held = None
+        self.upper = None
+        self.lower = None
+
+    def _filter(self, timestamp, value):
+        if self.pivot is None:
+            self._reset((timestamp, value))
+            return [self.pivot]
+
+        result = []
+        if self._outside_door(timestamp, value):
+            # Door closed. Publish the last value that was still inside it and
+            # swing a new door from there.
+            held = self.held
+            self.held = None
+            if held is not None:
+                result.append(held)
+                self._reset(held)
+            if held is None or self._outside_door(timestamp, value):
+                result.append((timestamp, value))
+                self._reset((timestamp, value))
+                return result
+
+        if (self.max_interval and
+                timestamp - self.pivot[0] >= self.max_interval):
+            # Heartbeat, publish regardless of the door
+            result.append((timestamp, value))
+            self._reset((timestamp, value))
+            self.held = None
+        else:
+            self.held = (timestamp, value)
+        return result
+
+    def flush(self):
+        with self.lock:
+            if self.held is None:
+                return []
+            held = self.held
+            self._reset(held)
+            self.held = None
+            return [held]
+
+    def _outside_door(self, timestamp, value):
+        """
+        Narrow the door with a new point, returning True if it has closed
+        """
+
+        pivot_timestamp, pivot_value = self.pivot
+        elapsed = timestamp - pivot_timestamp
+        if elapsed <= 0:
+            return abs(value - pivot_value) > self.deviation
+
+        upper = (value + self.deviation - pivot_value) / float(elapsed)
+        lower = (value - self.deviation - pivot_value) / float(elapsed)
+        if self.upper is None or upper < self.upper:
+            self.upper = upper
+        if self.lower is None or lower > self.lower:
+            self.lower = lower
+        return self.lower > self.upper
+
+    def _reset(self, point):
+        self.pivot = point
+        self.upper = None
+        self.lower = None
+
+
+class WindowAggregator(object):
+    """
+    Summarises the values of a single key over tumbling windows of a fixed
+    number of seconds, aligned to the epoch. Only the running minimum, maximum,
+    sum and count of the current window are kept. Closed windows are returned
+    as (window start, minimum, maximum, mean, count) tuples.
+    """
+
+    def __init__(self, window):
+        if window <= 0:
+            raise ValueError("Aggregation window must be positive")
+        self.window = window
+        self.lock = threading.Lock()
+        self.start = None
+        self.minimum = None
+        self.maximum = None
+        self.total = 0
+        self.count = 0
+
+    def add(self, timestamp, value):
+        """
+        Add a single value
+        """
+
+        with self.lock:
+            return self._add(timestamp, value)
+
+    def add_many(self, points):
+        """
+        Add a sequence of (timestamp, value) points in order
+        """
+
+        result = []
+        with self.lock:
+            for timestamp, value in points:
+                result.extend(self._add(timestamp, value))
+        return result
+
+    def expire(self, now):
+        """
+        Close the current window if it ended before now
+        """
+
+        with self.lock:
+            if self.start is not None and now >= self.start + self.window:
+                return [self._close()]
+            return []
+
+    def flush(self):
+        """
+        Close the current window, even if it has not ended yet
+        """
+
+        with self.lock:
+            if self.start is None:
+                return []
+            return [self._close()]
+
+    def _add(self, timestamp, value):
+        result = []
+        if self.start is not None and timestamp >= self.start + self.window:
+            result.append(self._close())
+
+        if self.start is None:
+            self.start = timestamp - timestamp % self.window
+            self.minimum = value
+            self.maximum = value
+        elif value < self.minimum:
+            self.minimum = value
+        elif value > self.maximum:
+            self.maximum = value
+        self.total += value
+        self.count += 1
+        return result
+
+    def _close(self):
+        summary = (self.start, self.minimum, self.maximum,
+                   self.total / float(self.count), self.count)
+        self.start = None
+        self.minimum = None
+        self.maximum = None
+        self.total = 0
+        self.count = 0
+        return summary
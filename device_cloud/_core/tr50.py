@@ -17,6 +17,7 @@ Client application
 """
 
 import json
+from datetime import datetime
 
 from device_cloud._core import constants
 
@@ -45,6 +46,10 @@ CLOUD_ERROR_CODES = {
 }
 
 
+# Second and formatted prefix of the last timestamp formatted
+_timestamp_prefix = (None, None)
+
+
 class TR50Command(object):
     """
     Holds all relevant TR50 command names
@@ -63,6 +68,7 @@ class TR50Command(object):
     mailbox_ack = "mailbox.ack"
     mailbox_check = "mailbox.check"
     mailbox_update = "mailbox.update"
+    property_batch = "property.batch"
     property_publish = "property.publish"
     thing_find = "thing.find"
 
@@ -283,6 +289,29 @@ def create_mailbox_update(mail_id, message):
     cmd["params"] = _generate_params(kwargs)
     return cmd
 
+def create_property_batch(thing_key, key, data, aggregate=None):
+    """
+    Generate a TR50 JSON request for publishing several numeric values of one
+    property to the Cloud. data is a list of (value, timestamp) pairs.
+    """
+
+    points = []
+    for value, timestamp in data:
+        point = {"value":value}
+        if timestamp is not None:
+            point["ts"] = timestamp
+        points.append(point)
+
+    kwargs = {
+        "thingKey":thing_key,
+        "key":key,
+        "data":points,
+        "aggregate":aggregate
+    }
+    cmd = {"command":TR50Command.property_batch}
+    cmd["params"] = _generate_params(kwargs)
+    return cmd
+
 def create_property_publish(thing_key, key, value, timestamp=None, corr_id=None,
                             aggregate=None):
     """
@@ -313,6 +342,29 @@ def create_thing_find(key):
     cmd["params"] = _generate_params(kwargs)
     return cmd
 
+def format_timestamp(timestamp):
+    """
+    Format a time in seconds since the epoch (UTC) as a Cloud timestamp. The
+    formatted date and time up to the second is cached, as consecutive
+    timestamps usually fall within the same second.
+    """
+
+    global _timestamp_prefix
+
+    second = int(timestamp // 1)
+    microsecond = int(round((timestamp - second) * 1000000))
+    if microsecond >= 1000000:
+        second += 1
+        microsecond -= 1000000
+
+    cached_second, prefix = _timestamp_prefix
+    if cached_second != second:
+        prefix = datetime.utcfromtimestamp(second).strftime(
+            constants.TIME_FORMAT[:constants.TIME_FORMAT.index("%f")])
+        _timestamp_prefix = (second, prefix)
+
+    return "{}{:06d}Z".format(prefix, microsecond)
+
 def generate_request(commands):
     """
     Generate a final TR50 request string out of multiple commands
@@ -331,6 +383,38 @@ def generate_request(commands):
 
     return json.dumps(request, separators=(",", ":"))
 
+def generate_requests(commands, max_commands=0, max_bytes=0):
+    """
+    Generate TR50 request strings out of multiple commands, starting a new
+    request whenever the next command would exceed max_commands commands or
+    max_bytes bytes (0 means no limit). A single command larger than max_bytes
+    is sent in a request of its own. Returns a list of (number of commands,
+    request string) tuples in command order.
+    """
+
+    requests = []
+    entries = []
+    size = 2
+    for command in commands:
+        encoded = json.dumps(command, separators=(",", ":"))
+        entry = "\"{}\":{}".format(len(entries) + 1, encoded)
+
+        # Close the current request if this command does not fit in it
+        if entries and ((max_commands and len(entries) >= max_commands) or
+                        (max_bytes and size + len(entry) + 1 > max_bytes)):
+            requests.append((len(entries), "{" + ",".join(entries) + "}"))
+            entries = []
+            size = 2
+            entry = "\"1\":{}".format(encoded)
+
+        entries.append(entry)
+        size += len(entry) + 1
+
+    if entries:
+        requests.append((len(entries), "{" + ",".join(entries) + "}"))
+
+    return requests
+
 def translate_error_code(error_code):
     """
     Return the related Cloud error code for a given device error code
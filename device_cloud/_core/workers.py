@@ -0,0 +1,231 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the pools of worker threads that handle each type of work
+"""
+
+import itertools
+import sys
+import threading
+from collections import deque
+from time import time
+
+from device_cloud._core import constants
+from device_cloud._core import defs
+
+if sys.version_info.major == 2:
+    import Queue as queue
+else:
+    import queue
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of a sorted list of values, 0 if it is empty
+    """
+
+    if not values:
+        return 0.0
+    rank = int(len(values) * percent / 100.0 + 0.5)
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class WorkerPool(object):
+    """
+    Elastic pool of worker threads serving their own queue of work, so that
+    slow work in one pool never holds up another. The pool keeps min_size
+    threads and adds one, up to max_size, whenever work is queued with no idle
+    thread left to take it, or the oldest queued work has waited longer than
+    wait_target seconds. Threads beyond min_size that have been idle for
+    idle_timeout seconds (0 for never) are retired. A queue size of 0 has no
+    limit.
+    """
+
+    def __init__(self, name, handle, max_size, queue_size=0, min_size=1,
+                 wait_target=constants.DEFAULT_WORKER_WAIT_TARGET,
+                 idle_timeout=constants.DEFAULT_WORKER_IDLE_TIMEOUT,
+                 poll_time=1, logger=None):
+        self.name = name
+        self.handle = handle
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.wait_target = wait_target
+        self.idle_timeout = idle_timeout
+        self.poll_time = poll_time
+        self.logger = logger
+        self.queue = defs.WorkQueue(queue_size)
+        self.lock = threading.Lock()
+        self.threads = []
+        self.thread_ids = itertools.count()
+        self.running = False
+
+        # Recent times work waited in the queue, in seconds
+        self.waits = deque(maxlen=constants.WORKER_WAIT_SAMPLES)
+
+    def __len__(self):
+        return len(self.threads)
+
+    def check(self):
+        """
+        Add a worker thread if the oldest queued work has waited longer than
+        wait_target. Returns True if one was added.
+        """
+
+        with self.queue.mutex:
+            oldest = self.queue.queue[0].queued if self.queue.queue else None
+        if oldest is None:
+            return False
+        waited = time() - oldest
+        if waited <= self.wait_target:
+            return False
+        with self.lock:
+            if not self.running or len(self.threads) >= self.max_size:
+                return False
+            self._add()
+            size = len(self.threads)
+        if self.logger:
+            self.logger.debug("Work waited %.3fs, %s pool grown to %d threads",
+                              waited, self.name, size)
+        return True
+
+    def is_worker(self, thread=None):
+        """
+        Returns True if a thread (the current one by default) is a worker of
+        this pool
+        """
+
+        if thread is None:
+            thread = threading.current_thread()
+        return thread in self.threads
+
+    def join(self):
+        """
+        Wait for stopped worker threads to finish the work in progress
+        """
+
+        current = threading.current_thread()
+        with self.lock:
+            threads = list(self.threads)
+        for thread in threads:
+            if thread is not current:
+                thread.join()
+        with self.lock:
+            self.threads = []
+
+    def put(self, work):
+        """
+        Queue work without waiting, adding a worker thread if there is more
+        work queued or in progress than threads. Returns False if the queue is
+        full.
+        """
+
+        work.queued = time()
+        try:
+            self.queue.put_nowait(work)
+        except queue.Full:
+            return False
+        # Work queued or in progress, counted without racing the workers
+        with self.queue.mutex:
+            outstanding = self.queue.unfinished_tasks
+        with self.lock:
+            grow = (self.running and len(self.threads) < self.max_size and
+                    outstanding > len(self.threads))
+            if grow:
+                self._add()
+                size = len(self.threads)
+        if not grow:
+            self.check()
+        elif self.logger:
+            self.logger.debug("No idle worker, %s pool grown to %d threads",
+                              self.name, size)
+        return True
+
+    def start(self):
+        """
+        Start the minimum number of worker threads
+        """
+
+        with self.lock:
+            self.running = True
+            while len(self.threads) < self.min_size:
+                self._add()
+
+    def stats(self):
+        """
+        Returns a dict of the number of threads, their bounds, the queued work
+        and the 50th, 90th and 99th percentiles of recent queue wait times
+        """
+
+        waits = sorted(self.waits)
+        return {"size":len(self.threads), "min_size":self.min_size,
+                "max_size":self.max_size, "queued":self.queue.qsize(),
+                "wait_p50":percentile(waits, 50),
+                "wait_p90":percentile(waits, 90),
+                "wait_p99":percentile(waits, 99)}
+
+    def stop(self):
+        """
+        Tell the worker threads to stop once they finish the work in progress
+        """
+
+        self.running = False
+
+    def wait(self, timeout=None, pending=0):
+        """
+        Wait up to timeout seconds for the queued work to be done, apart from
+        pending items in progress. Returns True if it was.
+        """
+
+        return self.queue.join(timeout, pending)
+
+    def _add(self):
+        # Start another worker thread, with the lock held
+        thread = threading.Thread(target=self._run, name="{}-{}".format(
+            self.name, next(self.thread_ids)))
+        self.threads.append(thread)
+        thread.start()
+
+    def _retire(self):
+        # Remove an idle worker thread, unless the pool is at its minimum
+        with self.lock:
+            if len(self.threads) <= self.min_size:
+                return False
+            self.threads.remove(threading.current_thread())
+            size = len(self.threads)
+        if self.logger:
+            self.logger.debug("Idle worker retired, %s pool shrunk to %d "
+                              "threads", self.name, size)
+        return True
+
+    def _run(self):
+        idle_since = time()
+        while self.running:
+            try:
+                work = self.queue.get(timeout=self.poll_time)
+            except queue.Empty:
+                if (self.idle_timeout and
+                        time() - idle_since >= self.idle_timeout and
+                        self._retire()):
+                    break
+                continue
+            self.waits.append(time() - work.queued)
+            try:
+                self.handle(work)
+            except Exception:
+                # Print traceback, but don't kill thread
+                if self.logger:
+                    self.logger.exception("Exception:")
+            finally:
+                self.queue.task_done()
+                idle_since = time()
@@ -0,0 +1,417 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the AsyncClient class, which runs the Client on an
+asyncio event loop instead of its own threads. Requires Python 3.5+.
+"""
+
+import asyncio
+import queue
+import threading
+from datetime import datetime
+
+import paho.mqtt.client as mqttlib
+
+from device_cloud._core import constants
+from device_cloud._core.client import Client
+
+
+class AsyncClient(Client):
+    """
+    Client driven by an asyncio event loop. The MQTT socket is watched with
+    add_reader/add_writer, so MQTT traffic, replies and publishing all run on
+    the loop's thread. connect, disconnect, the publish methods, file_download
+    and file_upload are coroutines, and publishes return the status of the
+    Cloud's reply. Actions whose callbacks are coroutine functions are
+    awaited on the loop. Other action callbacks and the HTTPS part of file
+    transfers run in the loop's default executor, since they block.
+
+    Other Client methods, such as telemetry_publish_many, are unchanged and
+    return as soon as their command is queued.
+    """
+
+    def __init__(self, app_id, kwargs=None, loop=None):
+        """
+        Start configuration of client. See Client for the parameters. loop is
+        the event loop to run on, by default the one running connect.
+        """
+
+        super(AsyncClient, self).__init__(app_id, kwargs)
+        self.loop = loop
+        self._sock = None
+        self._writing = False
+        self._connecting = None
+        self._publish_handle = None
+        self._service_task = None
+
+    async def connect(self, timeout=0):
+        """
+        Connect the Client to the Cloud
+
+        Parameters:
+          timeout             (number) Maximum time to try to connect
+
+        Returns:
+          STATUS_FAILURE               Failed to connect to Cloud
+          STATUS_SUCCESS               Successfully connected to Cloud
+          STATUS_TIMED_OUT             Connection attempt timed out
+        """
+
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        handler = self.handler
+
+        # The loop's thread takes the place of the main thread, and of the
+        # publish thread
+        handler.main_thread = threading.current_thread()
+        handler.publish_notify = self._publish_queued
+        if handler.spool is not None:
+            handler.spool.open()
+
+        # Resolving the host and the TLS handshake block, so they run in the
+        # executor
+        status = await self.loop.run_in_executor(None, handler.mqtt_connect)
+        if status == constants.STATUS_SUCCESS:
+            handler.logger.info("Connecting...")
+            self._connecting = self.loop.create_future()
+            self._watch()
+            await asyncio.wait([self._connecting], timeout=timeout or None)
+            self._connecting = None
+
+            if handler.state == constants.STATE_CONNECTED:
+                self._service_task = asyncio.ensure_future(self._service(),
+                                                           loop=self.loop)
+                return constants.STATUS_SUCCESS
+
+            if handler.state == constants.STATE_CONNECTING:
+                handler.logger.error("Connection timed out")
+                status = constants.STATUS_TIMED_OUT
+            else:
+                status = constants.STATUS_FAILURE
+
+        # Not connected
+        handler.logger.error("Failed to connect")
+        self._unwatch()
+        handler.to_quit = True
+        handler.state = constants.STATE_DISCONNECTED
+        return status
+
+    async def disconnect(self, wait_for_replies=False, timeout=0):
+        """
+        End Client connection to the Cloud
+
+        Parameters:
+          wait_for_replies      (bool) When True, wait for any pending replies
+                                       to be received or time out before
+                                       disconnecting
+          timeout             (number) Maximum time to wait before returning
+
+        Returns:
+          STATUS_SUCCESS               Successfully disconnected
+        """
+
+        handler = self.handler
+        handler.logger.info("Disconnecting...")
+
+        # Publish any data that was queued before disconnecting
+        handler.flush_telemetry()
+        self._publish()
+
+        # Optionally wait for any outstanding replies
+        if wait_for_replies and handler.is_connected():
+            handler.logger.info("Waiting for replies...")
+            pending = [asyncio.wrap_future(message.future, loop=self.loop)
+                       for message in handler.reply_tracker.messages()]
+            if pending:
+                await asyncio.wait(pending, timeout=timeout or None)
+
+        handler.to_quit = True
+        if self._service_task is not None:
+            self._service_task.cancel()
+            self._service_task = None
+        if self._publish_handle is not None:
+            self._publish_handle.cancel()
+            self._publish_handle = None
+
+        # Send the disconnect packet, then stop watching the socket
+        handler.mqtt.disconnect()
+        self._unwatch()
+        handler.state = constants.STATE_DISCONNECTED
+        handler.publish_notify = None
+        handler.abandon_replies()
+        if handler.spool is not None:
+            handler.spool.close()
+
+        return constants.STATUS_SUCCESS
+
+    async def alarm_publish(self, alarm_name, state, message=None):
+        """
+        Publish an alarm to the Cloud and wait for the reply. See
+        alarm_publish_async for the statuses returned.
+        """
+
+        return await self._result(self.alarm_publish_async(alarm_name, state,
+                                                           message))
+
+    async def attribute_publish(self, attribute_name, value):
+        """
+        Publish string telemetry to the Cloud and wait for the reply. See
+        attribute_publish_async for the statuses returned.
+        """
+
+        return await self._result(self.attribute_publish_async(attribute_name,
+                                                               value))
+
+    async def event_publish(self, message):
+        """
+        Publish an event message to the Cloud and wait for the reply. See
+        event_publish_async for the statuses returned.
+        """
+
+        return await self._result(self.event_publish_async(message))
+
+    async def location_publish(self, latitude, longitude, heading=None,
+                               altitude=None, speed=None, accuracy=None,
+                               fix_type=None):
+        """
+        Publish a location metric to the Cloud and wait for the reply. See
+        location_publish_async for the statuses returned.
+        """
+
+        return await self._result(self.location_publish_async(
+            latitude, longitude, heading=heading, altitude=altitude,
+            speed=speed, accuracy=accuracy, fix_type=fix_type))
+
+    async def telemetry_publish(self, telemetry_name, value):
+        """
+        Publish telemetry to the Cloud and wait for the reply. See
+        telemetry_publish_async for the statuses returned.
+        """
+
+        return await self._result(self.telemetry_publish_async(telemetry_name,
+                                                               value))
+
+    async def file_download(self, file_name, download_dest, callback=None,
+                            timeout=0, file_global=False):
+        """
+        Download a file from the Cloud to the device (C2D) and wait for the
+        transfer to complete. See Client.file_download for the parameters and
+        statuses returned. callback is run in the executor.
+        """
+
+        future = self.file_download_async(file_name, download_dest, callback,
+                                          file_global)
+        return await self._result(future, timeout)
+
+    async def file_upload(self, file_path, upload_name=None, callback=None,
+                          timeout=0, file_global=False):
+        """
+        Upload a file from the device to the Cloud (D2C) and wait for the
+        transfer to complete. See Client.file_upload for the parameters and
+        statuses returned. callback is run in the executor.
+        """
+
+        future = self.file_upload_async(file_path, upload_name, callback,
+                                        file_global)
+        return await self._result(future, timeout)
+
+    async def _handle_action(self, action_request):
+        handler = self.handler
+        action = handler.callbacks.get(action_request.name)
+        action_result = None
+        error = None
+        try:
+            if (action is not None and
+                    asyncio.iscoroutinefunction(action.callback)):
+                action_result = await action.execute(action_request)
+            else:
+                action_result = await self.loop.run_in_executor(
+                    None, handler.callbacks.execute_action, action_request)
+        except Exception as err:
+            error = err
+            if action is not None:
+                handler.logger.exception("Exception:")
+        handler.complete_action(action_request, action_result, error)
+        self._update_writer()
+
+    def _handle_work(self):
+        """
+        Handle work queued by received messages, without blocking the loop
+        """
+
+        handler = self.handler
+        for pool in handler.work_pools.values():
+            while True:
+                try:
+                    work = pool.queue.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    if work.type == constants.WORK_MESSAGE:
+                        handler.handle_message(work.data)
+                    elif work.type == constants.WORK_ACTION:
+                        asyncio.ensure_future(self._handle_action(work.data),
+                                              loop=self.loop)
+                    elif work.type == constants.WORK_DOWNLOAD:
+                        self.loop.run_in_executor(
+                            None, handler.handle_file_download, work.data)
+                    elif work.type == constants.WORK_UPLOAD:
+                        self.loop.run_in_executor(
+                            None, handler.handle_file_upload, work.data)
+                except Exception:
+                    # Print traceback, but keep handling work
+                    handler.logger.exception("Exception:")
+                finally:
+                    pool.queue.task_done()
+
+    def _on_readable(self):
+        handler = self.handler
+        if handler.mqtt.loop_read() != mqttlib.MQTT_ERR_SUCCESS:
+            # Connection lost, paho has closed the socket
+            self._unwatch()
+        self._handle_work()
+        self._update_writer()
+
+        if (self._connecting is not None and not self._connecting.done() and
+                handler.state != constants.STATE_CONNECTING):
+            self._connecting.set_result(handler.state)
+
+    def _on_writable(self):
+        if self.handler.mqtt.loop_write() != mqttlib.MQTT_ERR_SUCCESS:
+            self._unwatch()
+        else:
+            self._update_writer()
+
+    def _publish(self):
+        """
+        Send all pending publishes
+        """
+
+        self._publish_handle = None
+        try:
+            self.handler.handle_publish()
+        except Exception:
+            self.handler.logger.exception("Exception:")
+        self._update_writer()
+
+    def _publish_queued(self, pub):
+        """
+        Schedule sending after a publish is queued. Publishes are sent
+        publish_linger seconds after the first one is queued, or straight away
+        once publish_linger_count are pending or an urgent one is queued.
+        """
+
+        if threading.current_thread() is not self.handler.main_thread:
+            self.loop.call_soon_threadsafe(self._publish_queued, pub)
+            return
+
+        if (pub.priority <= constants.PRIORITY_IMMEDIATE or
+                self.handler.publish_queue.qsize() >=
+                self.config.publish_linger_count):
+            if self._publish_handle is not None:
+                self._publish_handle.cancel()
+            self._publish_handle = self.loop.call_soon(self._publish)
+        elif self._publish_handle is None:
+            self._publish_handle = self.loop.call_later(
+                self.config.publish_linger, self._publish)
+
+    async def _reconnect(self):
+        """
+        Reconnect after the connection was lost, unless keep_alive has passed
+        """
+
+        handler = self.handler
+        max_time = self.config.keep_alive
+        elapsed_time = (datetime.utcnow() -
+                        handler.last_connected).total_seconds()
+        if max_time != 0 and elapsed_time >= max_time:
+            handler.logger.error("No connection after %d seconds, exiting...",
+                                 max_time)
+            handler.to_quit = True
+            return
+
+        try:
+            result = await self.loop.run_in_executor(None,
+                                                     handler.mqtt.reconnect)
+        except Exception:
+            return
+        if result == 0:
+            handler.logger.debug("Reconnecting...")
+            handler.state = constants.STATE_CONNECTING
+            self._watch()
+
+    async def _result(self, future, timeout=0):
+        """
+        Wait for a concurrent.futures.Future without blocking the loop.
+        Returns STATUS_TIMED_OUT if it is not resolved within timeout seconds.
+        """
+
+        wrapped = asyncio.wrap_future(future, loop=self.loop)
+        self._update_writer()
+        done, _ = await asyncio.wait([wrapped], timeout=timeout or None)
+        if not done:
+            return constants.STATUS_TIMED_OUT
+        return wrapped.result()
+
+    async def _service(self):
+        """
+        Keep the connection alive and reconnect it, and handle the Handler's
+        timers, every loop_time seconds
+        """
+
+        handler = self.handler
+        while not handler.to_quit:
+            await asyncio.sleep(self.config.loop_time)
+            try:
+                if handler.state == constants.STATE_DISCONNECTED:
+                    self._unwatch()
+                    await self._reconnect()
+                elif (handler.mqtt.loop_misc() !=
+                      mqttlib.MQTT_ERR_SUCCESS):
+                    self._unwatch()
+                handler.handle_timers()
+                self._update_writer()
+            except Exception:
+                # Print traceback, but don't stop servicing the connection
+                handler.logger.exception("Exception:")
+
+    def _unwatch(self):
+        if self._sock is not None:
+            self.loop.remove_reader(self._sock)
+            if self._writing:
+                self.loop.remove_writer(self._sock)
+        self._sock = None
+        self._writing = False
+
+    def _update_writer(self):
+        """
+        Watch the socket for writing only while paho has data it could not
+        send straight away
+        """
+
+        if self._sock is None:
+            return
+        want_write = self.handler.mqtt.want_write()
+        if want_write and not self._writing:
+            self.loop.add_writer(self._sock, self._on_writable)
+        elif not want_write and self._writing:
+            self.loop.remove_writer(self._sock)
+        self._writing = want_write
+
+    def _watch(self):
+        self._unwatch()
+        self._sock = self.handler.mqtt.socket()
+        if self._sock is not None:
+            self.loop.add_reader(self._sock, self._on_readable)
+            self._update_writer()
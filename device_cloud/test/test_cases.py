@@ -13,6 +13,7 @@
     OR CONDITIONS OF ANY KIND, either express or implied.
 '''
 
+import array
 import json
 import os
 import unittest
@@ -20,9 +21,12 @@ from binascii import crc32
 import mock
 import platform
 import re
+import shutil
 import socket
 import ssl
 import sys
+import tempfile
+import threading
 
 # yocto supports websockets, not websocket, so check for that
 try:
@@ -31,9 +35,13 @@ except ImportError:
     import websockets as websocket
 
 from time import sleep
+from time import time
 
 import device_cloud
 import device_cloud.test.test_helpers as helpers
+from device_cloud._core import constants
+from device_cloud._core import defs
+from device_cloud._core import workers
 
 if sys.version_info.major == 2:
     builtin = "__builtin__"
@@ -262,13 +270,87 @@ class ClientAlarmPublish(unittest.TestCase):
         assert pub.name == "alarm_key"
         assert pub.state == 5
         assert pub.message == "alarm message"
-        work = self.client.handler.work_queue.get()
-        assert work.type == device_cloud._core.constants.WORK_PUBLISH
+        assert self.client.handler.publish_queue.flushing
 
     def setUp(self):
         # Configuration to be 'read' from config file
         self.config_args = helpers.config_file_default()
 
+@unittest.skipIf(sys.version_info < (3, 5), "AsyncClient requires Python 3.5+")
+class ClientAsyncConnectPublish(unittest.TestCase):
+    @mock.patch("ssl.SSLContext")
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_isfile,
+                mock_open, mock_context):
+        import asyncio
+        from device_cloud import aio
+
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        mock_isfile.side_effect = [True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client on its own event loop
+        self.loop = asyncio.new_event_loop()
+        kwargs = {"loop_time":1}
+        self.client = aio.AsyncClient("testing-client", kwargs, loop=self.loop)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+
+        # The MQTT socket is a socket pair. Every byte written to the other
+        # end makes the loop read a connack or the queued replies.
+        self.sock, self.cloud = socket.socketpair()
+        replies = []
+        def loop_read(max_packets=1):
+            self.sock.recv(1)
+            if handler.state == constants.STATE_CONNECTING:
+                handler.on_connect(mqtt, None, None, 0)
+            while replies:
+                handler.on_message(mqtt, None, replies.pop(0))
+            return 0
+        def publish(topic, payload, qos):
+            reply = mock.Mock()
+            reply.topic = topic.replace("api/", "reply/")
+            reply.payload = json.dumps({"1":{"success":True}}).encode()
+            replies.append(reply)
+            self.cloud.send(b"x")
+            return (0, 1)
+        mqtt.socket.return_value = self.sock
+        mqtt.want_write.return_value = False
+        mqtt.loop_read.side_effect = loop_read
+        mqtt.publish.side_effect = publish
+
+        # Connect, publish and wait for the reply on a single thread
+        self.cloud.send(b"x")
+        run = self.loop.run_until_complete
+        assert run(self.client.connect(timeout=5)) == device_cloud.STATUS_SUCCESS
+        assert self.client.is_connected() is True
+        assert run(self.client.attribute_publish("status", "running")) == device_cloud.STATUS_SUCCESS
+        assert mqtt.publish.call_args[0][0] == "api/0001"
+        assert run(self.client.telemetry_publish("property_key", 1)) == device_cloud.STATUS_SUCCESS
+        assert handler.main_thread is threading.current_thread()
+        assert handler.publish_thread is None
+        assert run(self.client.disconnect()) == device_cloud.STATUS_SUCCESS
+        mqtt.disconnect.assert_called_once()
+        assert self.client.is_connected() is False
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+    def tearDown(self):
+        self.sock.close()
+        self.cloud.close()
+        self.loop.close()
+
 class ClientAttributePublish(unittest.TestCase):
     @mock.patch(builtin + ".open")
     @mock.patch("os.path.exists")
@@ -864,6 +946,152 @@ class ClientTelemetryPublish(unittest.TestCase):
         # Configuration to be 'read' from config file
         self.config_args = helpers.config_file_default()
 
+class ClientTelemetryPublishMany(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0, "publish_max_batch":2}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        mqtt = self.client.handler.mqtt
+
+        # Mismatched timestamps are rejected
+        values = array.array("d", [1.0, 2.0, 3.0])
+        result = self.client.telemetry_publish_many("property_key", values,
+                                                    [0.0])
+        assert result == device_cloud.STATUS_BAD_PARAMETER
+        assert self.client.handler.publish_queue.empty()
+
+        # Queue a whole block as one record
+        result = self.client.telemetry_publish_many("property_key", values,
+                                                    [0.0, 0.5, 1.0])
+        assert result == device_cloud.STATUS_SUCCESS
+        assert self.client.handler.publish_queue.qsize() == 1
+        values[0] = 9.0
+        assert self.client.handler.handle_publish() == device_cloud.STATUS_SUCCESS
+
+        # Block is split into batches of publish_max_batch values
+        jload = json.loads(mqtt.publish.call_args_list[0][0][1])
+        assert len(jload) == 2
+        assert jload["1"]["command"] == "property.batch"
+        assert jload["1"]["params"]["data"] == [
+            {"value":1.0, "ts":"1970-01-01T00:00:00.000000Z"},
+            {"value":2.0, "ts":"1970-01-01T00:00:00.500000Z"}]
+        assert jload["2"]["params"]["data"] == [
+            {"value":3.0, "ts":"1970-01-01T00:00:01.000000Z"}]
+
+        # Without timestamps, values are spread over an interval so they
+        # don't share one
+        result = self.client.telemetry_publish_many("property_key", values)
+        assert result == device_cloud.STATUS_BAD_PARAMETER
+        result = self.client.telemetry_publish_many("property_key", values,
+                                                    interval=0.25, start=10.0)
+        assert result == device_cloud.STATUS_SUCCESS
+        assert self.client.handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        jload = json.loads(mqtt.publish.call_args_list[1][0][1])
+        data = jload["1"]["params"]["data"] + jload["2"]["params"]["data"]
+        assert [point["ts"] for point in data] == [
+            "1970-01-01T00:00:10.000000Z", "1970-01-01T00:00:10.250000Z",
+            "1970-01-01T00:00:10.500000Z"]
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class ClientTelemetryPublishDeadband(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+
+        # Only values outside the deadband are queued
+        for value in [20.0, 20.2, 20.6, 20.7, 20.0]:
+            result = self.client.telemetry_publish("property_key", value)
+            assert result == device_cloud.STATUS_SUCCESS
+        self.client.telemetry_publish("other_key", 20.1)
+        queued = []
+        while not self.client.handler.publish_queue.empty():
+            queued.append(self.client.handler.publish_queue.get())
+        assert [(pub.name, pub.value) for pub in queued] == [
+            ("property_key", 20.0), ("property_key", 20.6),
+            ("property_key", 20.0), ("other_key", 20.1)]
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+        self.config_args["telemetry_compression"] = {
+            "property_key":{"deadband":0.5}}
+
+class ClientTelemetryPublishAggregate(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+
+        # Raw values of an aggregated key are never queued
+        values = array.array("d", [4.0, 1.0, 7.0, 2.0])
+        result = self.client.telemetry_publish_many("property_key", values,
+                                                    [100.0, 101.0, 105.0, 112.0])
+        assert result == device_cloud.STATUS_SUCCESS
+
+        # First window closed when a value arrived for the next one
+        queued = []
+        while not handler.publish_queue.empty():
+            queued.append(handler.publish_queue.get())
+        assert [(pub.name, pub.value, pub.timestamp) for pub in queued] == [
+            ("property_key.min", 1.0, 100.0),
+            ("property_key.max", 7.0, 100.0),
+            ("property_key.mean", 4.0, 100.0),
+            ("property_key.count", 3, 100.0)]
+
+        # Second window closes once its time has passed
+        aggregator = handler.telemetry_aggregators["property_key"]
+        assert aggregator.expire(115.0) == []
+        handler.queue_summaries("property_key", aggregator.expire(120.0))
+        assert handler.publish_queue.qsize() == 4
+        assert handler.publish_queue.get().value == 2.0
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+        self.config_args["telemetry_aggregation"] = {
+            "property_key":{"window":10}}
+
 class ConfigMissingHost(unittest.TestCase):
     @mock.patch(builtin + ".open")
     @mock.patch("os.path.exists")
@@ -1244,13 +1472,13 @@ class HandlePublishAllTypes(unittest.TestCase):
         assert jload["3"]["params"]["speed"] == 55.55
         assert jload["3"]["params"]["fixAcc"] == 66.66
         assert jload["3"]["params"]["fixType"] == "gps"
-        assert jload["4"]["command"] == "log.publish"
+        assert jload["4"]["command"] == "property.publish"
         assert jload["4"]["params"]["thingKey"] == thing_key
-        assert jload["4"]["params"]["msg"] == "Event Message"
-        assert jload["5"]["command"] == "property.publish"
+        assert jload["4"]["params"]["key"] == "property_key"
+        assert jload["4"]["params"]["value"] == 12.34
+        assert jload["5"]["command"] == "log.publish"
         assert jload["5"]["params"]["thingKey"] == thing_key
-        assert jload["5"]["params"]["key"] == "property_key"
-        assert jload["5"]["params"]["value"] == 12.34
+        assert jload["5"]["params"]["msg"] == "Event Message"
 
         # Set up and 'receive' reply from Cloud
         ack_payload = {"1":{"success":True},
@@ -1276,6 +1504,177 @@ class HandlePublishAllTypes(unittest.TestCase):
         if self.client.handler.main_thread:
             self.client.handler.main_thread.join()
 
+class HandlePublishCoalesce(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with coalescing
+        kwargs = {"loop_time":1, "thread_count":0, "publish_coalesce":True,
+                  "publish_on_change":["mode"]}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        mqtt = self.client.handler.mqtt
+
+        # Only the newest attribute and alarm of each name are sent
+        self.client.attribute_publish("status", "starting")
+        self.client.alarm_publish("overheat", 1)
+        self.client.telemetry_publish("property_key", 1)
+        self.client.attribute_publish("status", "running")
+        self.client.alarm_publish("overheat", 0)
+        self.client.attribute_publish("mode", "auto")
+        assert self.client.handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        jload = json.loads(mqtt.publish.call_args_list[0][0][1])
+        assert len(jload) == 4
+        assert jload["1"]["params"]["state"] == 0
+        assert jload["2"]["params"]["value"] == "running"
+        assert jload["3"]["params"]["value"] == "auto"
+        assert jload["4"]["command"] == "property.publish"
+
+        # Unchanged on change attributes are not sent again
+        self.client.attribute_publish("mode", "auto")
+        self.client.attribute_publish("status", "running")
+        assert self.client.handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        jload = json.loads(mqtt.publish.call_args_list[1][0][1])
+        assert len(jload) == 1
+        assert jload["1"]["params"]["key"] == "status"
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishSplitPayloads(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with small payload limits
+        kwargs = {"loop_time":1, "thread_count":0,
+                  "publish_max_commands":2, "publish_max_bytes":400}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        mqtt = self.client.handler.mqtt
+
+        # Queue more publishes than fit in one payload
+        for num in range(5):
+            self.client.event_publish("event message {}".format(num))
+        self.client.event_publish("x" * 500)
+        assert self.client.handler.handle_publish() == device_cloud.STATUS_SUCCESS
+
+        # Each payload holds at most two commands, the oversized one is alone
+        assert mqtt.publish.call_count == 4
+        sent = [json.loads(args[0][1]) for args in mqtt.publish.call_args_list]
+        assert [len(payload) for payload in sent] == [2, 2, 1, 1]
+        assert sent[0]["1"]["params"]["msg"] == "event message 0"
+        assert sent[0]["2"]["params"]["msg"] == "event message 1"
+        assert sent[2]["1"]["params"]["msg"] == "event message 4"
+        assert sent[3]["1"]["params"]["msg"] == "x" * 500
+        topics = [args[0][0] for args in mqtt.publish.call_args_list]
+        assert len(set(topics)) == 4
+        assert len(self.client.handler.reply_tracker) == 6
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishTelemetryBatch(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        mqtt = self.client.handler.mqtt
+
+        # Queue several samples of one key and a single sample of another
+        self.client.telemetry_publish("property_key", 1.5)
+        self.client.telemetry_publish("property_key", 2.5)
+        self.client.telemetry_publish("other_key", 7)
+        self.client.telemetry_publish("property_key", 3.5)
+        assert self.client.handler.handle_publish() == device_cloud.STATUS_SUCCESS
+
+        # Samples of the same key are sent as one batch command
+        mqtt.publish.assert_called_once()
+        jload = json.loads(mqtt.publish.call_args_list[0][0][1])
+        assert len(jload) == 2
+        assert jload["1"]["command"] == "property.batch"
+        assert jload["1"]["params"]["key"] == "property_key"
+        data = jload["1"]["params"]["data"]
+        assert [point["value"] for point in data] == [1.5, 2.5, 3.5]
+        assert all("ts" in point for point in data)
+        assert jload["2"]["command"] == "property.publish"
+        assert jload["2"]["params"]["key"] == "other_key"
+        assert jload["2"]["params"]["value"] == 7
+        assert len(self.client.handler.reply_tracker) == 2
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishTimestamps(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        mqtt = self.client.handler.mqtt
+
+        # Publish records are compact and hold a raw epoch timestamp
+        attr = device_cloud._core.defs.PublishAttribute("attribute_key", "on")
+        assert not hasattr(attr, "__dict__")
+        attr.timestamp = 1500000000.25
+        event = device_cloud._core.defs.PublishLog("Event Message")
+        event.timestamp = 1500000001.999999
+        self.client.handler.queue_publish(attr)
+        self.client.handler.queue_publish(event)
+        assert self.client.handler.handle_publish() == device_cloud.STATUS_SUCCESS
+
+        # Timestamps are only formatted when sent
+        jload = json.loads(mqtt.publish.call_args_list[0][0][1])
+        assert jload["1"]["params"]["ts"] == "2017-07-14T02:40:00.250000Z"
+        assert jload["2"]["params"]["ts"] == "2017-07-14T02:40:01.999999Z"
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
 class HandlerInitMissingKey(unittest.TestCase):
     @mock.patch(builtin + ".open")
     @mock.patch("os.path.exists")
@@ -1328,6 +1727,1027 @@ class HandlerInitWebsockets(unittest.TestCase):
         self.config_args = helpers.config_file_default()
         self.config_args["cloud"]["port"] = 443
 
+class HandleWaitState(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        handler.to_quit = False
+
+        # Waiting times out while the state is unchanged
+        handler.state = constants.STATE_CONNECTING
+        assert handler.wait_state(constants.STATE_CONNECTING, 0.01) == constants.STATE_CONNECTING
+
+        # A change of state from another thread ends the wait straight away
+        timer = threading.Timer(0.05, setattr,
+                                (handler, "state", constants.STATE_CONNECTED))
+        start = time()
+        timer.start()
+        assert handler.wait_state(constants.STATE_CONNECTING, 5) == constants.STATE_CONNECTED
+        assert time() - start < 1
+        timer.join()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandleMailboxPaging(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with small mailbox pages
+        kwargs = {"loop_time":1, "thread_count":0, "mailbox_page_size":3,
+                  "mailbox_watermark":2}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+
+        def mails(*mail_ids):
+            return {"1":{"success":True,
+                         "params":{"messages":[{"command":"method.exec",
+                                                "id":mail_id,
+                                                "params":{"method":"action"}}
+                                               for mail_id in mail_ids]}}}
+
+        # A notification requests one page
+        notify = defs.Message("notify/mailbox_activity", {})
+        assert handler.handle_message(notify) == device_cloud.STATUS_SUCCESS
+        jload = json.loads(mqtt.publish.call_args_list[0][0][1])
+        assert jload["1"]["command"] == "mailbox.check"
+        assert jload["1"]["params"]["limit"] == 3
+
+        # Another notification waits for the check in progress
+        handler.handle_message(notify)
+        assert mqtt.publish.call_count == 1
+
+        # A full page reaches the watermark, so the next page waits
+        handler.handle_message(defs.Message("reply/0001", mails("a", "b", "c")))
+        assert mqtt.publish.call_count == 1
+        assert handler.work_pools["action"].queue.qsize() == 3
+        action = handler.work_pools["action"].queue.get_nowait().data
+        handler.complete_action(action, device_cloud.STATUS_SUCCESS)
+        assert mqtt.publish.call_count == 2
+
+        # Completing an action fetches the next page
+        action = handler.work_pools["action"].queue.get_nowait().data
+        handler.complete_action(action, device_cloud.STATUS_SUCCESS)
+        assert mqtt.publish.call_count == 4
+        jload = json.loads(mqtt.publish.call_args_list[3][0][1])
+        assert jload["1"]["command"] == "mailbox.check"
+
+        # Actions already in progress are not queued again, and a short page
+        # ends the paging
+        handler.handle_message(defs.Message("reply/0004", mails("c")))
+        assert handler.work_pools["action"].queue.qsize() == 1
+        action = handler.work_pools["action"].queue.get_nowait().data
+        handler.complete_action(action, device_cloud.STATUS_SUCCESS)
+        assert mqtt.publish.call_count == 5
+        assert handler.mailbox_actions == set()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandleMailboxRepeatedPage(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with a watermark that would never hold back a page
+        kwargs = {"loop_time":1, "thread_count":0, "mailbox_page_size":2,
+                  "mailbox_watermark":0, "mailbox_cache_size":2,
+                  "action_queue_size":1}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+        assert handler.config.mailbox_watermark == 1
+        handler.mailbox_cache = defs.MailCache(max_size=2)
+        action_queue = handler.work_pools["action"].queue
+
+        def mails(*mail_ids):
+            return {"1":{"success":True,
+                         "params":{"messages":[{"command":"method.exec",
+                                                "id":mail_id,
+                                                "params":{"method":"action"}}
+                                               for mail_id in mail_ids]}}}
+
+        def commands():
+            return [json.loads(call[0][1])["1"]["command"]
+                    for call in mqtt.publish.call_args_list]
+
+        # A full page with more actions than the action queue holds leaves the
+        # rest for the next page, fetched once an action completes
+        handler.handle_message(defs.Message("notify/mailbox_activity", {}))
+        handler.handle_message(defs.Message("reply/0001", mails("a", "b")))
+        assert action_queue.qsize() == 1
+        assert handler.mailbox_pending
+        assert commands() == ["mailbox.check"]
+        action = action_queue.get_nowait().data
+        handler.complete_action(action, device_cloud.STATUS_SUCCESS)
+        assert commands() == ["mailbox.check", "mailbox.ack", "mailbox.check"]
+        handler.handle_message(defs.Message("reply/0003", mails("b")))
+        action = action_queue.get_nowait().data
+        handler.complete_action(action, device_cloud.STATUS_SUCCESS)
+
+        # The same full page delivered again, before the Cloud has seen the
+        # acks, holds nothing new, so no more pages are requested
+        handler.handle_message(defs.Message("notify/mailbox_activity", {}))
+        count = mqtt.publish.call_count
+        topic = "reply/{:04d}".format(count)
+        handler.handle_message(defs.Message(topic, mails("a", "b")))
+        assert commands()[count:] == ["mailbox.ack", "mailbox.ack"]
+        assert not handler.mailbox_pending
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandleMailboxCache(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0, "mailbox_cache_size":1}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+
+        # Keep the cache in memory, saving it is covered by MailCacheReload
+        assert handler.mailbox_cache.path.endswith("testing-client-mailbox.json")
+        handler.mailbox_cache = defs.MailCache(max_size=1)
+
+        def mails(*mail_ids):
+            return {"1":{"success":True,
+                         "params":{"messages":[{"command":"method.exec",
+                                                "id":mail_id,
+                                                "params":{"method":"action"}}
+                                               for mail_id in mail_ids]}}}
+
+        notify = defs.Message("notify/mailbox_activity", {})
+
+        def deliver(*mail_ids):
+            # Answer a mailbox check with these actions
+            handler.handle_message(notify)
+            topic = "reply/{:04d}".format(mqtt.publish.call_count)
+            handler.handle_message(defs.Message(topic, mails(*mail_ids)))
+
+        # Execute an action, its ack is kept
+        deliver("a")
+        action = handler.work_pools["action"].queue.get_nowait().data
+        handler.complete_action(action, device_cloud.STATUS_SUCCESS)
+        ack = json.loads(mqtt.publish.call_args_list[-1][0][1])["1"]
+        assert ack["command"] == "mailbox.ack"
+        assert handler.mailbox_cache.get("a")
+
+        # The same action delivered again is answered with the same ack
+        # instead of being executed
+        deliver("a")
+        assert handler.work_pools["action"].queue.qsize() == 0
+        assert json.loads(mqtt.publish.call_args_list[-1][0][1])["1"] == ack
+
+        # Only the most recent acks are kept
+        deliver("b")
+        action = handler.work_pools["action"].queue.get_nowait().data
+        handler.complete_action(action, device_cloud.STATUS_SUCCESS)
+        assert len(handler.mailbox_cache) == 1
+        assert handler.mailbox_cache.get("a") is None
+
+        # An action still running after being invoked is not answered from
+        # the cache until its final ack
+        deliver("c")
+        action = handler.work_pools["action"].queue.get_nowait().data
+        handler.complete_action(action, device_cloud.STATUS_INVOKED)
+        update = json.loads(mqtt.publish.call_args_list[-1][0][1])["1"]
+        assert update["command"] == "mailbox.update"
+        assert handler.mailbox_cache.get("c") is None
+        assert handler.mailbox_cache.get("b")
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class MailCacheReload(unittest.TestCase):
+    def runTest(self):
+        path = os.path.join(self.cache_dir, "mailbox.json")
+        cache = defs.MailCache(path, 2)
+        cache.put("a", {"command":"mailbox.ack"}, "Ack a")
+        cache.put("b", {"command":"mailbox.ack"}, "Ack b")
+        cache.put("c", {"command":"mailbox.ack"}, "Ack c")
+        assert not os.path.exists(path + ".tmp")
+
+        # The newest acks survive a restart
+        cache = defs.MailCache(path, 2)
+        assert len(cache) == 2
+        assert cache.get("a") is None
+        assert cache.get("c") == ({"command":"mailbox.ack"}, "Ack c")
+
+        # A corrupt file is discarded with a warning
+        with open(path, "w") as cache_file:
+            cache_file.write("[[\"a\", {")
+        logger = mock.Mock()
+        cache = defs.MailCache(path, 2, logger)
+        assert len(cache) == 0
+        assert logger.warning.call_count == 1
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+class HandleWorkPools(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with one transfer thread and a short queue
+        kwargs = {"loop_time":1, "thread_count":1, "transfer_thread_count":1,
+                  "transfer_queue_size":1}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+
+        release = threading.Event()
+        handled = threading.Event()
+        handler.handle_file_download = mock.Mock(
+            side_effect=lambda transfer: release.wait(5))
+        handler.handle_message = mock.Mock(
+            side_effect=lambda message: handled.set())
+        for pool in handler.work_pools.values():
+            pool.start()
+        try:
+            # A slow download does not hold up received messages
+            download = defs.Work(constants.WORK_DOWNLOAD, None)
+            assert handler.queue_work(download) == device_cloud.STATUS_SUCCESS
+            assert handler.queue_work(defs.Work(constants.WORK_MESSAGE, None)) \
+                   == device_cloud.STATUS_SUCCESS
+            assert handled.wait(5)
+
+            # Each pool limits its own queue
+            transfers = handler.work_pools["transfer"]
+            for _ in range(50):
+                if transfers.queue.qsize() == 0:
+                    break
+                sleep(0.1)
+            assert handler.queue_work(download) == device_cloud.STATUS_SUCCESS
+            assert handler.queue_work(download) == device_cloud.STATUS_FULL
+        finally:
+            release.set()
+            assert handler.work_pools["transfer"].wait(5)
+            for pool in handler.work_pools.values():
+                pool.stop()
+            for pool in handler.work_pools.values():
+                pool.join()
+        assert handler.handle_file_download.call_count == 2
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandleMessageRaw(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+
+        # The network thread only queues the raw payload
+        msg = mock.Mock()
+        msg.topic = "reply/0000"
+        msg.payload = json.dumps({"1":{"success":True}}).encode()
+        handler.on_message(handler.mqtt, None, msg)
+        work = handler.work_pools["message"].queue.get_nowait()
+        assert work.data.payload == msg.payload
+        assert handler.handle_message(work.data) == device_cloud.STATUS_SUCCESS
+        assert work.data.json == {"1":{"success":True}}
+        assert work.data.payload is None
+
+        # Payloads that are not JSON are rejected by the worker
+        msg.payload = b"{not json"
+        handler.on_message(handler.mqtt, None, msg)
+        work = handler.work_pools["message"].queue.get_nowait()
+        assert handler.handle_message(work.data) == device_cloud.STATUS_PARSE_ERROR
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishFutures(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+
+        attr_future = self.client.attribute_publish_async("status", "running")
+        telem_futures = [self.client.telemetry_publish_async("property_key", 1),
+                         self.client.telemetry_publish_async("property_key", 2)]
+        log_future = self.client.event_publish_async("event")
+        assert handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        assert not attr_future.done()
+
+        # Futures are resolved by the replies to their commands. Both samples
+        # share one batch command.
+        reply = defs.Message("reply/0001", {"1":{"success":True},
+                                            "2":{"success":True},
+                                            "3":{"success":False,
+                                                 "errorCodes":[-90000]}})
+        assert handler.handle_message(reply) == device_cloud.STATUS_SUCCESS
+        assert attr_future.result(0) == device_cloud.STATUS_SUCCESS
+        for future in telem_futures:
+            assert future.result(0) == device_cloud.STATUS_SUCCESS
+        assert log_future.result(0) == device_cloud.STATUS_FAILURE
+
+        # File transfers resolve with their status
+        download_future = self.client.file_download_async("file.txt",
+                                                          "/nonexistent/file.txt")
+        reply = defs.Message("reply/0002", {"1":{"success":False,
+                                                 "errorCodes":[-90008]}})
+        handler.handle_message(reply)
+        assert download_future.result(0) == device_cloud.STATUS_NOT_FOUND
+        assert self.client.file_download("file.txt", "/nonexistent/file.txt",
+                                         blocking=True,
+                                         timeout=0.01) == device_cloud.STATUS_TIMED_OUT
+        upload_future = self.client.file_upload_async("relative/file.txt")
+        assert upload_future.result(0) == device_cloud.STATUS_NOT_FOUND
+
+        # Resolving a future again quietly keeps its first result
+        with mock.patch("concurrent.futures._base.LOGGER") as mock_logger:
+            defs.set_result(attr_future, device_cloud.STATUS_FAILURE)
+        assert attr_future.result(0) == device_cloud.STATUS_SUCCESS
+        mock_logger.critical.assert_not_called()
+
+        # Publishes discarded from a full queue resolve with STATUS_FULL
+        handler.publish_queue = defs.PublishQueue(1, "drop_oldest")
+        first_future = self.client.event_publish_async("first")
+        second_future = self.client.event_publish_async("second")
+        assert first_future.result(0) == device_cloud.STATUS_FULL
+        assert not second_future.done()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandleReconnectResubmit(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+        mqtt.publish.side_effect = [(0, 1), (0, 2), (0, 3)]
+
+        # Two payloads, only the first acknowledged by the broker
+        self.client.attribute_publish("status", "running")
+        self.client.location_publish(1.0, 2.0)
+        log_future = self.client.event_publish_async("event")
+        assert handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        self.client.telemetry_publish("property_key", 1)
+        assert handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        handler.on_publish(None, None, 1)
+
+        # The commands of the acknowledged payload that can safely be repeated
+        # are sent again together, the others time out
+        handler.on_connect(mqtt, None, None, 0)
+        assert mqtt.publish.call_count == 3
+        args = mqtt.publish.call_args_list[2][0]
+        assert args[0] == "api/0003"
+        jload = json.loads(args[1])
+        assert len(jload) == 2
+        assert jload["1"]["command"] == "attribute.publish"
+        assert jload["2"]["command"] == "location.publish"
+        assert len(handler.reply_tracker) == 3
+        assert log_future.result(0) == device_cloud.STATUS_TIMED_OUT
+        assert self.client.reply_stats()["expired"] == 1
+
+        # Nothing is sent again without an acknowledgement
+        handler.on_connect(mqtt, None, None, 0)
+        assert mqtt.publish.call_count == 3
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandleReplyTimeouts(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with short reply timeouts
+        kwargs = {"loop_time":1, "thread_count":0, "reply_timeout":10,
+                  "reply_timeouts":{"file.get":5}, "reply_retries":1}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+        start = time()
+
+        self.client.attribute_publish("status", "running")
+        self.client.event_publish("event")
+        assert handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        callback = mock.Mock()
+        assert self.client.file_download("file.txt", "/nonexistent/file.txt",
+                                         callback=callback) == device_cloud.STATUS_SUCCESS
+        assert self.client.reply_stats()["in_flight"] == 3
+
+        # The file request is repeated first
+        handler.sweep_replies(start + 6)
+        assert mqtt.publish.call_count == 3
+        jload = json.loads(mqtt.publish.call_args_list[2][0][1])
+        assert jload["1"]["command"] == "file.get"
+
+        # The attribute is repeated, the log and the file request expire
+        handler.sweep_replies(start + 11)
+        assert mqtt.publish.call_count == 4
+        jload = json.loads(mqtt.publish.call_args_list[3][0][1])
+        assert jload["1"]["command"] == "attribute.publish"
+        assert self.client.reply_stats() == {"in_flight":1, "retried":2,
+                                             "expired":2}
+        callback.assert_called_once_with(self.client, "file.txt",
+                                         device_cloud.STATUS_TIMED_OUT)
+
+        # The repeated attribute waits twice as long before expiring
+        handler.sweep_replies(start + 19)
+        assert self.client.reply_stats()["in_flight"] == 1
+        handler.sweep_replies(start + 25)
+        assert self.client.reply_stats() == {"in_flight":0, "retried":2,
+                                             "expired":3}
+
+        # Time spent disconnected does not count towards the deadlines
+        self.client.event_publish("event")
+        assert handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        message = handler.reply_tracker.messages()[0]
+        deadline = message.deadline
+        handler.state = constants.STATE_DISCONNECTED
+        handler.last_sweep -= 20
+        assert handler.handle_timers() == device_cloud.STATUS_SUCCESS
+        assert message.deadline >= deadline + 20
+        assert self.client.reply_stats()["in_flight"] == 1
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishSpool(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with a spool
+        kwargs = {"loop_time":1, "thread_count":0, "publish_spool":True,
+                  "spool_drain_rate":0, "config_dir":self.spool_dir}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+
+        # Publishes go to the spool while disconnected
+        self.client.telemetry_publish("property_key", 1)
+        self.client.attribute_publish("status", "offline")
+        assert handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        assert mqtt.publish.call_count == 0
+        assert len(handler.spool) == 2
+
+        # Spooled publishes are sent once connected
+        handler.state = constants.STATE_CONNECTED
+        assert handler.drain_spool() == device_cloud.STATUS_SUCCESS
+        assert len(handler.spool) == 0
+        assert handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        jload = json.loads(mqtt.publish.call_args_list[0][0][1])
+        assert jload["1"]["params"]["value"] == "offline"
+        assert jload["2"]["params"]["key"] == "property_key"
+        assert jload["2"]["params"]["value"] == 1
+
+        # The spool can be closed and opened again for the next connection
+        handler.spool.put([defs.PublishLog("offline")])
+        handler.spool.close()
+        handler.spool.close()
+        handler.spool.open()
+        assert len(handler.spool) == 1
+        handler.spool.close()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+class HandlePublishQueueFull(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with a small queue that rejects new publishes
+        kwargs = {"loop_time":1, "thread_count":0, "publish_queue_size":2,
+                  "publish_queue_policy":"drop_newest"}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+
+        assert self.client.telemetry_publish("property_key", 1) == device_cloud.STATUS_SUCCESS
+        assert self.client.telemetry_publish("property_key", 2) == device_cloud.STATUS_SUCCESS
+        assert self.client.telemetry_publish("property_key", 3) == device_cloud.STATUS_FULL
+        assert self.client.event_publish("full") == device_cloud.STATUS_FULL
+        stats = self.client.publish_queue_stats()
+        assert stats["size"] == 2
+        assert stats["dropped"] == 2
+
+        # More urgent publishes replace the oldest telemetry
+        assert self.client.alarm_publish("overheat", 1) == device_cloud.STATUS_SUCCESS
+        stats = self.client.publish_queue_stats()
+        assert stats["lanes"] == [1, 0, 1, 0]
+        assert stats["dropped"] == 3
+        assert self.client.handler.publish_queue.get().name == "overheat"
+        assert self.client.handler.publish_queue.get().value == 2
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishLogging(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client logging one in every two payloads
+        kwargs = {"loop_time":1, "thread_count":0, "log_payload_sample":2}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        handler.logger = mock.Mock()
+        handler.logger.isEnabledFor.return_value = True
+
+        for value in range(3):
+            self.client.attribute_publish("status", str(value))
+            assert handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        calls = handler.logger.info.call_args_list
+        assert len(calls) == 2
+        assert calls[0][0][1:3] == ("0001", 1)
+        assert calls[1][0][1:3] == ("0003", 1)
+        assert json.loads(str(calls[1][0][4]))["params"]["value"] == "2"
+
+        # A summary replaces the payloads
+        handler.logger.reset_mock()
+        handler.config.log_payload_summary = True
+        self.client.attribute_publish("status", "summary")
+        self.client.telemetry_publish("property_key", 1)
+        self.client.telemetry_publish("property_key", 2)
+        assert handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        calls = handler.logger.info.call_args_list
+        assert len(calls) == 1
+        assert calls[0][0][1] == 1
+        assert calls[0][0][2] == "1 attribute.publish, 1 property.batch"
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishUnlocked(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+
+        # Publish happens outside of the lock, after the messages are tracked,
+        # and may complete before its MID is added
+        def publish(topic, payload, qos):
+            assert not handler.reply_tracker.lock.locked()
+            assert handler.reply_tracker.get_message(1, 1) is not None
+            handler.on_publish(None, None, 7)
+            return (0, 7)
+        handler.mqtt.publish.side_effect = publish
+
+        self.client.attribute_publish("status", "running")
+        assert handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        assert handler.mqtt.publish.call_count == 1
+        assert not handler.reply_tracker.mid_tracker
+        assert not handler.reply_tracker.mids_done
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishNoReply(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client without replies for telemetry
+        kwargs = {"loop_time":1, "thread_count":0,
+                  "publish_no_reply":["telemetry"]}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+
+        # Telemetry is sent at QoS 0 and not tracked
+        self.client.telemetry_publish("property_key", 1)
+        self.client.attribute_publish("status", "running")
+        assert handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        assert mqtt.publish.call_count == 2
+        args = mqtt.publish.call_args_list[0][0]
+        assert args[0] == "api/0001"
+        assert args[2] == 1
+        assert json.loads(args[1])["1"]["command"] == "attribute.publish"
+        args = mqtt.publish.call_args_list[1][0]
+        assert args[0] == "api/0000"
+        assert args[2] == 0
+        assert json.loads(args[1])["1"]["command"] == "property.publish"
+        assert len(handler.reply_tracker) == 1
+
+        # Replies to untracked commands are ignored
+        reply = defs.Message("reply/0000", {"1":{"success":True}})
+        assert handler.handle_message(reply) == device_cloud.STATUS_SUCCESS
+        assert len(handler.reply_tracker) == 1
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishPriority(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid, json.dumps(self.config_args)]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with small rounds of publishes
+        kwargs = {"loop_time":1, "thread_count":0, "publish_max_batch":4}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+
+        # An alarm queued after a telemetry backlog is sent in the first round
+        for value in range(10):
+            self.client.telemetry_publish("property_key", value)
+        self.client.event_publish("event")
+        assert not handler.publish_queue.flushing
+        self.client.alarm_publish("overheat", 1)
+        assert handler.publish_queue.flushing
+        assert handler.handle_publish() == device_cloud.STATUS_SUCCESS
+        assert mqtt.publish.call_count == 3
+        jload = json.loads(mqtt.publish.call_args_list[0][0][1])
+        assert jload["1"]["command"] == "alarm.publish"
+        assert jload["2"]["command"] == "property.batch"
+        assert len(jload["2"]["params"]["data"]) == 2
+        assert jload["3"]["command"] == "log.publish"
+
+        # The remaining telemetry follows in later rounds
+        jload = json.loads(mqtt.publish.call_args_list[1][0][1])
+        assert len(jload["1"]["params"]["data"]) == 4
+        jload = json.loads(mqtt.publish.call_args_list[2][0][1])
+        assert len(jload["1"]["params"]["data"]) == 4
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class OutTrackerSlots(unittest.TestCase):
+    def runTest(self):
+        tracker = defs.OutTracker(2)
+        first = [defs.OutMessage({}, "first-1"), defs.OutMessage({}, "first-2")]
+        second = [defs.OutMessage({}, "second-1")]
+        assert tracker.add_messages(first) == 1
+        assert tracker.add_messages(second) == 2
+        assert tracker.topic(2) == "0002"
+        assert first[1].out_id == (1, 2)
+        assert len(tracker) == 3
+
+        # No free topic until every reply of one has arrived
+        assert tracker.add_messages([defs.OutMessage({}, "third")], 0) is None
+        assert tracker.pop_message(1, 2).description == "first-2"
+        self.assertRaises(KeyError, tracker.pop_message, 1, 2)
+        self.assertRaises(KeyError, tracker.pop_message, 3, 1)
+        assert tracker.add_messages([defs.OutMessage({}, "third")], 0) is None
+        assert tracker.pop_message(1, 1).description == "first-1"
+        assert tracker.add_messages([defs.OutMessage({}, "third")], 0) == 1
+        assert len(tracker) == 2
+
+        # Topics can be dropped as a whole
+        tracker.remove_topic(2)
+        assert [message.description for message in tracker.messages()] == ["third"]
+        assert len(tracker) == 1
+
+class PublishQueueJoin(unittest.TestCase):
+    def runTest(self):
+        # Publishes are done once task_done is called for them
+        pub_queue = defs.PublishQueue(2, "drop_oldest")
+        assert pub_queue.join(0) is True
+        for value in range(3):
+            assert pub_queue.put(value)
+        assert pub_queue.get_many() == [1, 2]
+        assert pub_queue.join(0.01) is False
+        pub_queue.task_done(2)
+        assert pub_queue.join(0.01) is True
+        self.assertRaises(ValueError, pub_queue.task_done)
+
+        # Work in progress on the calling thread can be excluded
+        work_queue = defs.WorkQueue()
+        work_queue.put(1)
+        work_queue.put(2)
+        work_queue.get()
+        assert work_queue.join(0.01, 1) is False
+        work_queue.get()
+        work_queue.task_done()
+        assert work_queue.join(0.01, 1) is True
+        work_queue.task_done()
+        assert work_queue.join(0.01) is True
+
+class WorkerPoolElastic(unittest.TestCase):
+    def runTest(self):
+        release = threading.Event()
+        handled = []
+
+        def handle(work):
+            release.wait(5)
+            handled.append(work.data)
+
+        def wait_for(condition):
+            for _ in range(100):
+                if condition():
+                    return True
+                sleep(0.05)
+            return False
+
+        pool = workers.WorkerPool("test", handle, 3, min_size=1,
+                                  wait_target=0.01, idle_timeout=0.2,
+                                  poll_time=0.05)
+        pool.start()
+        assert len(pool) == 1
+        try:
+            # Threads are added while work waits too long, up to max_size
+            for value in range(4):
+                assert pool.put(defs.Work(constants.WORK_MESSAGE, value))
+            def grown():
+                pool.check()
+                return len(pool) == 3
+            assert wait_for(grown)
+            sleep(0.05)
+            assert pool.check() is False
+            assert len(pool) == 3
+
+            # Idle threads are retired down to min_size
+            release.set()
+            assert pool.wait(5)
+            assert sorted(handled) == [0, 1, 2, 3]
+            assert wait_for(lambda: len(pool) == 1)
+            stats = pool.stats()
+            assert stats["size"] == 1
+            assert stats["queued"] == 0
+            assert 0 < stats["wait_p50"] <= stats["wait_p90"] <= stats["wait_p99"]
+        finally:
+            release.set()
+            pool.stop()
+            pool.join()
+        assert len(pool) == 0
+        assert workers.percentile([], 50) == 0.0
+        assert workers.percentile([1, 2, 3, 4], 50) == 2
+        assert workers.percentile([1, 2, 3, 4], 99) == 4
+
+class WorkerPoolBurst(unittest.TestCase):
+    def runTest(self):
+        release = threading.Event()
+
+        def handle(work):
+            release.wait(5)
+
+        # A burst of work grows the pool as it is queued, without waiting for
+        # wait_target
+        pool = workers.WorkerPool("test", handle, 3, min_size=1,
+                                  wait_target=60, poll_time=0.05)
+        pool.start()
+        try:
+            for value in range(3):
+                assert pool.put(defs.Work(constants.WORK_MESSAGE, value))
+            assert len(pool) == 3
+            assert pool.put(defs.Work(constants.WORK_MESSAGE, 3))
+            assert len(pool) == 3
+            release.set()
+            assert pool.wait(5)
+        finally:
+            release.set()
+            pool.stop()
+            pool.join()
+
+class PublishQueuePolicies(unittest.TestCase):
+    def runTest(self):
+        # Oldest publishes are discarded
+        pub_queue = defs.PublishQueue(2, "drop_oldest")
+        for value in range(4):
+            assert pub_queue.put(value)
+        assert pub_queue.stats()["dropped"] == 2
+        assert pub_queue.get() == 2
+        assert pub_queue.get() == 3
+        assert pub_queue.empty()
+
+        # One in every three new publishes replaces the oldest
+        pub_queue = defs.PublishQueue(2, "sample", sample=3)
+        results = [pub_queue.put(value) for value in range(8)]
+        assert results == [True, True, False, False, True, False, False, True]
+        assert pub_queue.get() == 4
+        assert pub_queue.get() == 7
+
+        # Blocking gives up after the timeout
+        pub_queue = defs.PublishQueue(1, "block", timeout=0.01)
+        assert pub_queue.put(0)
+        assert not pub_queue.put(1)
+        assert not pub_queue.put(2, block=False)
+        assert pub_queue.stats()["blocked"] == 1
+        assert pub_queue.stats()["dropped"] == 2
+
+        # Lanes are drained in weighted round robin
+        pub_queue = defs.PublishQueue(weights=[2, 1])
+        for value in range(4):
+            pub_queue.put("low{}".format(value), 1)
+            pub_queue.put("high{}".format(value), 0)
+        assert pub_queue.get_many(3) == ["high0", "high1", "low0"]
+        assert pub_queue.get_many() == ["high2", "high3", "low1", "low2",
+                                        "low3"]
+
+        # Waits end after the linger, or once enough publishes are pending
+        pub_queue = defs.PublishQueue()
+        assert pub_queue.wait(2, 0.01, timeout=0.01) == 0
+        pub_queue.put(0)
+        assert pub_queue.wait(2, 0.01, timeout=0.01) == 1
+        pub_queue.put(1)
+        assert pub_queue.wait(2, 10, timeout=10) == 2
+        pub_queue.flush()
+        assert pub_queue.wait(3, 10, timeout=10) == 2
+
+        # Unknown policies are refused
+        self.assertRaises(ValueError, defs.PublishQueue, 1, "drop_random")
+
+class TelemetrySwingingDoor(unittest.TestCase):
+    def runTest(self):
+        telemetry = device_cloud._core.telemetry
+        door = telemetry.create_filter({"swinging_door":0.5,
+                                        "max_interval":100})
+        assert isinstance(door, telemetry.SwingingDoorFilter)
+
+        # Points on a straight line are held back
+        published = door.filter_many([(0, 0.0), (1, 1.0), (2, 2.1), (3, 2.9)])
+        assert published == [(0, 0.0)]
+
+        # A change of direction publishes the last point on the line
+        assert door.filter(4, 0.0) == [(3, 2.9)]
+        assert door.filter(5, 0.0) == [(4, 0.0)]
+
+        # Heartbeat publishes after max_interval
+        assert door.filter(50, 0.0) == []
+        assert door.filter(104, 0.1) == [(104, 0.1)]
+
+        # Flushing returns anything held back
+        assert door.filter(105, 0.1) == []
+        assert door.flush() == [(105, 0.1)]
+        assert door.flush() == []
+
 class OTAExecute(unittest.TestCase):
     @mock.patch("os.path.isdir")
     @mock.patch("os.system")
@@ -32,7 +32,8 @@ setup(
         'requests',
         'certifi',
         'websocket-client',
-        'PySocks'
+        'PySocks',
+        'futures; python_version < "3"'
         ],
     maintainer='Paul Barrette',
     maintainer_email='paul.barrette@windriver.com',